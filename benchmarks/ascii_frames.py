@@ -0,0 +1,54 @@
+"""
+Animated ascii conversion: where the time goes, and how the parallel
+frames mode scales with worker processes.
+
+    python -m benchmarks.ascii_frames [image.gif]
+"""
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from os import cpu_count
+from time import perf_counter
+
+from PIL import Image
+
+from core.ascii import renderer
+
+
+def timed(func, *args, **kwargs) -> float:
+    start = perf_counter()
+    func(*args, **kwargs)
+    return perf_counter() - start
+
+
+def main(path: str = "assets/rocket_league.gif"):
+    data = open(path, "rb").read()
+    renderer_ = renderer(512)
+    half = renderer_.resized(256)
+    img = Image.open(BytesIO(data))
+    inv = renderer_.get_invert(img)
+    print(f"{path}: {img.n_frames} frames, {img.width}x{img.height}")
+
+    frames = []
+    render = timed(lambda: frames.extend(half.render_indices(f, inv) for f in half.quantize_gif(img, inv)))
+    print(f"{'composite+render':>24}: {render:.2f}s")
+    for preset, minimize in ((1, False), (3, False), (1, True)):
+        encode = timed(renderer_.images_to_webp, frames, 40, lossless_preset=preset, minimize_size=minimize)
+        print(f"{f'encode preset={preset} min={minimize:d}':>24}: {encode:.2f}s")
+    frames.clear()
+
+    serial = timed(lambda: renderer_.animate(Image.open(BytesIO(data)), inv))
+    print(f"\n{'serial':>10}: {serial:.2f}s")
+    workers = 1
+    while workers <= (cpu_count() or 1):
+        with ProcessPoolExecutor(workers) as pool:
+            # Warm the workers up so their renderer is already built
+            list(pool.map(renderer, [256] * workers))
+            pooled = timed(lambda: renderer_.animate(Image.open(BytesIO(data)), inv,
+                                                     submit=pool.submit, window=2 * workers))
+        print(f"{f'{workers} workers':>10}: {pooled:.2f}s ({serial / pooled:.2f}x)")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,61 @@
+"""
+Turning an image into character indices: the integer luma, invert
+detection and lookup-table quantization against the float pipeline
+stringify_image used before, which inverted with ImageOps and summed
+the channels.
+
+    python -m benchmarks.ascii_quantize [image]
+"""
+import sys
+from time import perf_counter
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from core.ascii import renderer
+
+REPEAT = 20
+
+
+def timed(func, *args) -> float:
+    start = perf_counter()
+    for _ in range(REPEAT):
+        func(*args)
+    return (perf_counter() - start) / REPEAT
+
+
+def sum_invert(img: Image.Image) -> bool:
+    # What get_invert did: it summed the full-size image down to one value
+    data = np.sum(np.asarray(img))
+    return bool(np.sum(data >= data.max() - 5) < np.sum(data <= data.min() + 5))
+
+
+def float_quantize(renderer_, img: Image.Image, inv: bool) -> np.ndarray:
+    if inv:
+        img = ImageOps.invert(img.convert("RGB"))
+    data = np.sum(np.asarray(img.convert("RGB").resize((renderer_.columns, renderer_.get_height(img)))), axis=2)
+    data -= data.min()
+    scaled = (1.0 - data / max(data.max(), 1)) ** renderer_.intensity * (renderer_.chars.size - 1)
+    return scaled.astype(np.uint8)
+
+
+def main(path: str = "assets/lemon.jpg"):
+    img = Image.open(path)
+    img.load()
+    print(f"{path}: {img.width}x{img.height}")
+    for width in (256, 512, 1024):
+        renderer_ = renderer(width)
+        luma = renderer_.luma(img)
+        inv = renderer_.luma_invert(luma)
+
+        print(f"\nwidth={width}, {luma.shape[1]}x{luma.shape[0]} chars")
+        print(f"{'float pipeline':>16}: {timed(float_quantize, renderer_, img, inv) * 1000:8.2f}ms")
+        print(f"{'old invert':>16}: {timed(sum_invert, img) * 1000:8.2f}ms")
+        print(f"{'luma':>16}: {timed(renderer_.luma, img) * 1000:8.2f}ms")
+        print(f"{'luma_invert':>16}: {timed(renderer_.luma_invert, luma) * 1000:8.2f}ms")
+        print(f"{'quantize_luma':>16}: {timed(renderer_.quantize_luma, luma, inv) * 1000:8.2f}ms")
+        print(f"{'quantize_image':>16}: {timed(renderer_.quantize_image, img, inv) * 1000:8.2f}ms")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
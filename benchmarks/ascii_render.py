@@ -0,0 +1,47 @@
+"""
+Drawing ascii art: the glyph atlas against ImageDraw.text on the joined
+string, which string_to_png used to do on every call.
+
+    python -m benchmarks.ascii_render [image]
+"""
+import sys
+from time import perf_counter
+
+from PIL import Image, ImageDraw as ID
+
+from core.ascii import renderer
+
+REPEAT = 3
+
+
+def timed(func, *args) -> float:
+    start = perf_counter()
+    for _ in range(REPEAT):
+        func(*args)
+    return (perf_counter() - start) / REPEAT
+
+
+def draw_text(renderer_, text: str) -> Image.Image:
+    w, h = ID.Draw(Image.new("RGB", (128, 128))).textsize(text, font=renderer_.font)
+    image = Image.new("RGB", (w, h), (255, 255, 255))
+    ID.Draw(image).text((0, 0), text, (0, 0, 0), font=renderer_.font)
+    return image
+
+
+def main(path: str = "assets/lemon.jpg"):
+    img = Image.open(path)
+    print(f"{path}: {img.width}x{img.height}")
+    for width in (256, 512, 1024):
+        renderer_ = renderer(width)
+        indices = renderer_.quantize_image(img)
+        text = renderer_.indices_to_string(indices)
+        assert draw_text(renderer_, text).size == renderer_.render_indices(indices).size
+
+        print(f"\nwidth={width}, {indices.shape[1]}x{indices.shape[0]} chars")
+        print(f"{'ImageDraw.text':>16}: {timed(draw_text, renderer_, text) * 1000:8.2f}ms")
+        print(f"{'atlas':>16}: {timed(renderer_.render_indices, indices) * 1000:8.2f}ms")
+        print(f"{'atlas + png':>16}: {timed(renderer_.indices_to_png, indices) * 1000:8.2f}ms")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,61 @@
+"""
+Cost of turning an eval snippet into a function: the old
+regex/test-compile/template path against core.repl, cold and cached.
+
+    python -m benchmarks.eval_compile
+"""
+import re
+from textwrap import indent
+from timeit import timeit
+
+from core.repl import _compile, compile_snippet
+
+SNIPPETS = {
+    "expression": "len(bot.guilds)",
+    "statement": "x = 5",
+    "stat dump": "\n".join(
+        [f"s{i} = sum(len(str(g)) for g in range({i}))" for i in range(20)]
+        + ["{k: v for k, v in globals().items() if k.startswith('s')}"]
+    ),
+}
+
+OLD_FMT = """
+async def func():
+    try:
+{body}
+    finally:
+        env.update(locals())
+""".strip()
+
+
+def old_compile(stmt: str):
+    # What EvalCog.any_eval did before: guess, test-compile, wrap, compile
+    lines = [line.strip() for line in stmt.split("\n") if line.strip()]
+    stmt = "\n".join(lines)
+    if len(lines) == 1 and not (";" in stmt or re.search(r"[^><!=~+\-/*%]=[^=]", stmt)):
+        try:
+            compile("_ = " + stmt, "<eval-repl>", "exec")
+            stmt = "_ = " + stmt + "\nreturn _"
+        except SyntaxError:
+            pass
+    env = {}
+    exec(compile(OLD_FMT.format(body=indent(stmt, " " * 8)), "<eval-repl>", "exec"), env)
+    return env["func"]
+
+
+def cold(source: str):
+    _compile.cache_clear()
+    compile_snippet(source, {})
+
+
+def main(number: int = 2000):
+    for name, source in SNIPPETS.items():
+        old = timeit(lambda: old_compile(source), number=number) / number
+        new = timeit(lambda: cold(source), number=number) / number
+        compile_snippet(source, {})
+        cached = timeit(lambda: compile_snippet(source, {}), number=number) / number
+        print(f"{name:>10}: old {old * 1e6:8.1f}us  cold {new * 1e6:8.1f}us  cached {cached * 1e6:6.2f}us")
+
+
+if __name__ == "__main__":
+    main()
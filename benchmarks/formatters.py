@@ -0,0 +1,45 @@
+"""
+Eval output formatting on 1M-element results: plain repr/pformat, which
+the formatters used to call, against the budgeted formatters.
+
+    python -m benchmarks.formatters
+"""
+from collections import Counter, OrderedDict
+from pprint import pformat
+from time import perf_counter
+
+from core.formatters import IPythonEvalFormatter, SimpleEvalFormatter
+
+N = 1_000_000
+
+
+def timed(func, *args) -> float:
+    start = perf_counter()
+    func(*args)
+    return perf_counter() - start
+
+
+def main():
+    cases = {
+        "list": list(range(N)),
+        "dict": {i: str(i) for i in range(N)},
+        "OrderedDict": OrderedDict((i, i) for i in range(N)),
+        "Counter": Counter(range(N)),
+        "set": set(range(N)),
+        "nested": [[list(range(100)) for _ in range(100)] for _ in range(100)],
+        "str": "x" * N,
+    }
+    simple, ipython = SimpleEvalFormatter(), IPythonEvalFormatter()
+
+    print(f"{'':>12} {'repr':>8} {'pformat':>8} {'simple':>8} {'ipython':>8}")
+    for name, value in cases.items():
+        print(f"{name:>12} {timed(repr, value):8.3f} {timed(pformat, value):8.3f} "
+              f"{timed(simple.format, 'x', value, ''):8.3f} {timed(ipython.format, 'x', value, ''):8.3f}")
+
+    printed = "\n".join(f"line {i}" for i in range(N))
+    print(f"{'printed':>12} {'':>8} {'':>8} {timed(simple.format, 'x', None, printed):8.3f} "
+          f"{timed(ipython.format, 'x', None, printed):8.3f}")
+
+
+if __name__ == "__main__":
+    main()
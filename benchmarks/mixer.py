@@ -0,0 +1,56 @@
+"""
+Frames mixed per second on one core, for Mixer (crossfades) and
+MixerSource (N summed tracks).
+
+    python -m benchmarks.mixer
+"""
+from time import perf_counter
+
+import numpy as np
+from discord import AudioSource
+from discord.opus import Encoder
+
+from core.music.sources import Mixer, MixerSource
+
+SECONDS = 2.0
+
+
+class Noise(AudioSource):
+    """ Endless source cycling through a few random frames """
+    def __init__(self, seed: int):
+        rng = np.random.default_rng(seed)
+        self.frames = [rng.integers(-32768, 32767, Encoder.FRAME_SIZE // 2, dtype=np.int16).tobytes()
+                       for _ in range(8)]
+        self.i = 0
+
+    def read(self) -> bytes:
+        self.i += 1
+        return self.frames[self.i % len(self.frames)]
+
+
+def rate(step) -> float:
+    count = 0
+    start = perf_counter()
+    while perf_counter() - start < SECONDS:
+        for _ in range(100):
+            step()
+        count += 100
+    return count / (perf_counter() - start)
+
+
+def main():
+    a, b = Noise(0), Noise(1)
+    for curve in (Mixer.LINEAR, Mixer.EQUAL_POWER):
+        mixer = Mixer(50, curve)
+        print(f"{f'Mixer {curve} fade':>26}: {rate(lambda: mixer.mix(a.read(), b.read(), 25)):>9,.0f} frames/s")
+    mixer = Mixer(50)
+    print(f"{'Mixer plain add':>26}: {rate(lambda: mixer.mix(a.read(), b.read())):>9,.0f} frames/s")
+
+    for tracks in (1, 2, 4, 8):
+        source = MixerSource(*(Noise(i) for i in range(tracks)))
+        print(f"{f'MixerSource {tracks} tracks':>26}: {rate(source.read):>9,.0f} frames/s")
+    # One frame is 20 ms of audio, so a core keeps up with rate / 50 streams
+
+
+if __name__ == "__main__":
+    main()
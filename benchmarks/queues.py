@@ -0,0 +1,69 @@
+"""
+Adding and then draining 10k songs from 100 requesters with each QUEUE
+type, then extending an empty queue with a 10k song playlist and
+shuffling it. Times the synchronous _add/_get/_extend/_shuffle, so only
+the data structures are measured and not the asyncio locking around them.
+The list and heappush rows are what Queue and PriorityQueue used to do.
+
+    python -m benchmarks.queues
+"""
+from heapq import heappop, heappush
+from random import Random
+from time import perf_counter
+
+from core.music.queues import QUEUE
+
+N = 10_000
+USERS = 100
+
+
+class Song:
+    def cleanup(self):
+        pass
+
+
+def timed(func) -> float:
+    start = perf_counter()
+    func()
+    return perf_counter() - start
+
+
+def main():
+    rng = Random(0)
+    requests = [(Song(), rng.randrange(USERS), rng.randrange(5)) for _ in range(N)]
+    types = {
+        "Simple": QUEUE.Simple,
+        "Chunked": lambda: QUEUE.Chunked(chunk_size=2),
+        "Priority": QUEUE.Priority,
+        "ChunkedPriority": lambda: QUEUE.ChunkedPriority(chunk_size=2),
+    }
+
+    print(f"{N} songs, {USERS} users")
+    print(f"{'':>16} {'add':>8} {'get':>8} {'extend':>8} {'shuffle':>8}")
+    for name, factory in types.items():
+        queue = factory()
+
+        def add():
+            for song, user, priority in requests:
+                queue._add(song, requester_id=user, priority=priority)
+
+        def get():
+            for _ in range(N):
+                queue._get()
+
+        add_time, get_time = timed(add), timed(get)
+        queue = factory()
+        extend_time = timed(lambda: queue._extend([song for song, _, _ in requests], requester_id=0))
+        print(f"{name:>16} {add_time:8.3f} {get_time:8.3f} {extend_time:8.3f} {timed(queue._shuffle):8.3f}")
+
+    songs = []
+    heap = []
+    print(f"{'list':>16} {timed(lambda: [songs.append(song) for song, _, _ in requests]):8.3f} "
+          f"{timed(lambda: [songs.pop(0) for _ in range(N)]):8.3f}")
+    print(f"{'heappush':>16} "
+          f"{timed(lambda: [heappush(heap, (-p, i, s)) for i, (s, _, p) in enumerate(requests)]):8.3f} "
+          f"{timed(lambda: [heappop(heap) for _ in range(N)]):8.3f}")
+
+
+if __name__ == "__main__":
+    main()
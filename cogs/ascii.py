@@ -1,130 +1,136 @@
+import asyncio
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from functools import partial
 from io import BytesIO
-from typing import Union, List
-from urllib.parse import urlparse
-from PIL import Image, ImageDraw as ID, ImageFont, ImageOps
-from aiohttp import ClientSession
+from os import cpu_count
+from typing import Callable, Deque, Tuple
+from PIL import Image
 from discord import File
 from discord.ext.commands import command, Bot
-import numpy as np
-from webp import WebPAnimEncoder, WebPPicture, WebPAnimEncoderOptions
 
-BLACK = (0, 0, 0)
-WHITE = (255, 255, 255)
+from core.ascii import AsciiRenderer, JobStats, renderer
+from core.cache import TieredCache
+from core.http import Fetcher, FetchError
+from core.jobs import JobQueue, QueueFull
 
 
 class AsciiCog:
-    def __init__(self, img_width: int = 512):
+    def __init__(self, img_width: int = 512, sizes: Tuple[int, ...] = (256, 512), workers: int = None,
+                 threads: int = 2, max_pending: int = 16, small_pixels: int = 512 * 512,
+                 parallel_frames: bool = False, cache_dir: str = ".cache/ascii"):
         self.width = img_width
-
-        self.chars = np.asarray(list(' .,:;irsXA253hMHGS#9B&@'))
-        self.image_scale = 0.5
-        self.intensity = 1.2
-        self.width_correction = 7 / 4
-        self.default = ID.Draw(Image.new("RGB", (128, 128)))
-        self.font = ImageFont.truetype("assets/CourierNew.ttf", 18)
-
-    def get_height(self, img: Image.Image) -> int:
-        w, h = img.size
-        ratio = self.width / w
-        new_height = h * ratio
-        return new_height
-
-    @staticmethod
-    def get_invert(img: Image.Image) -> bool:
-        data_img = np.sum(np.asarray(img))
-        invert = np.sum(data_img >= data_img.max() - 5) < np.sum(data_img <= data_img.min() + 5)
-        return bool(invert)
-
-    def stringify(self, img: Image.Image, filename: str) -> BytesIO:
-        file = urlparse(filename).path
-        inv = self.get_invert(img)
-        if file.endswith("gif"):
-            self.width /= 2
-            duration = img.info['duration']
-            frames = self.stringify_gif(img, inv)
-            gif = self.string_to_gif(frames, duration, inv)
-            self.width *= 2
-            return gif
-
-        elif any(file.endswith(x) for x in ("png", "jpg", "jpeg")):
-            string = self.stringify_image(img, inv)
-            return self.string_to_png(string, inv)
-        raise Exception("Unsupported file type")
-
-    def stringify_gif(self, img: Image.Image, inv: bool = False) -> List[str]:
-        frames = []
-        current = img.convert("RGBA")
-        while True:
-            try:
-                frames.append(self.stringify_image(current.convert("RGB"), inv))
-                img.seek(img.tell()+1)
-                current = Image.alpha_composite(current, img.convert('RGBA'))
-            except EOFError:
-                break
-
-        return frames
-
-    def string_to_gif(self, frames: List[str], duration: float, inv: bool = False) -> BytesIO:
-        as_images = [self.string_to_png(frame, inv, True) for frame in frames]
-
-        b = BytesIO()
-        # as_images[0].save(b, format='gif', duration=duration/2, save_all=True, append_images=as_images[1:], loop=100)
-
-        enc = WebPAnimEncoder.new(*as_images[0].size, WebPAnimEncoderOptions.new(minimize_size=True))
-        t = 0
-        for img in as_images:
-            pic = WebPPicture.from_pil(img)
-            enc.encode_frame(pic, round(t))
-            t += duration
-
-        data = enc.assemble(round(t))
-        b.write(data.buffer())
-
-        b.seek(0)
-        return b
-
-    def stringify_image(self, img: Image.Image, inv: bool = False) -> str:
-        if inv:
-            img = ImageOps.invert(img.convert("RGB"))
-        new_size = (round(self.width * self.width_correction * self.image_scale),
-                    round(self.get_height(img) * self.image_scale))
-
-        data_img = np.sum(np.asarray(img.resize(new_size)), axis=2)
-        data_img -= data_img.min()
-
-        scaled_img = (1.0 - data_img / data_img.max()) ** self.intensity * (self.chars.size - 1)
-
-        stringified_img = "\n".join(
-            "".join(r)
-            for r in self.chars[scaled_img.astype(int)]
-        )
-
-        return stringified_img
-
-    def string_to_png(self, ascii_: str, inv: bool = False, as_img: bool = False) -> Union[BytesIO, Image.Image]:
-        w, h = self.default.textsize(ascii_, font=self.font)
-        blank = Image.new("RGB", (w, h), [WHITE, BLACK][inv])
-        draw = ID.Draw(blank)
-        draw.text((0, 0), ascii_, [BLACK, WHITE][inv], font=self.font)
-        if as_img:
-            return blank
-        fp = BytesIO()
-        blank.save(fp, format="png")
-        fp.seek(0)
-        return fp
+        # Renderers are immutable, so these are shared by every request
+        self.renderers = {size: renderer(size) for size in {*sizes, img_width}}
+
+        self.small_pixels = small_pixels
+        self.parallel_frames = parallel_frames
+        self.cache = TieredCache(cache_dir)
+        # Measured by the worker that ran each of the most recent jobs;
+        # memory only for the process pool's
+        self.stats: Deque[JobStats] = deque(maxlen=100)
+        self.fetcher = Fetcher()
+        workers = workers or cpu_count() or 1
+        self.frame_window = 2 * workers
+        self.jobs = JobQueue(ProcessPoolExecutor(workers), workers, max_pending)
+        self.small_jobs = JobQueue(ThreadPoolExecutor(threads), threads, max_pending)
+        # Compositing and encoding threads for parallel_frames; their frames
+        # go through self.jobs like any other job
+        self.animations = JobQueue(ThreadPoolExecutor(threads), threads, max_pending)
+
+    def __unload(self):
+        self.jobs.shutdown()
+        self.small_jobs.shutdown()
+        self.animations.shutdown()
+        asyncio.ensure_future(self.fetcher.close())
+
+    def renderer(self, width: int = None) -> AsciiRenderer:
+        width = width or self.width
+        return self.renderers.get(width) or renderer(width)
 
     @command()
-    async def ascii(self, ctx, image_url: str):
-        async with ClientSession as session:
-            async with session.get(image_url) as response:
-                data: bytes = await response.read()
+    async def ascii(self, ctx, image_url: str, as_text: bool = False):
+        try:
+            fetched = await self.fetcher.fetch(image_url)
+        except FetchError as e:
+            return await ctx.send(str(e))
+
+        with fetched:
+            renderer_ = self.renderer()
+            key = TieredCache.key(fetched.digest, params=renderer_.params, as_text=as_text)
+            cached = await self.cache.get_async(key)
+            if cached is None:
+                # The buffer is shared with concurrent fetches of the same
+                # URL, so it's read without awaiting in between. Image.open
+                # only parses the header, so this is cheap on the loop
+                img = Image.open(fetched.open())
+                w, h = img.size
+                animated = getattr(img, "is_animated", False)
+                data = fetched.read()
+
+        if cached is not None:
+            result, filename = cached
+            return await ctx.send(file=File(BytesIO(result), filename=filename))
+
+        # DMs have no guild; queue those per user instead
+        owner = ctx.guild.id if ctx.guild is not None else ctx.author.id
+        if self.parallel_frames and not as_text and animated:
+            # The compositing thread fans frames out to the process pool
+            submit = partial(self.jobs.submit_threadsafe, asyncio.get_event_loop(), owner)
+            jobs, args = self.animations, (animate_job, data, renderer_, submit, self.frame_window)
+        elif w * h <= self.small_pixels:
+            jobs, args = self.small_jobs, (render_job, data, renderer_, as_text)
+        else:
+            # Only the process pool's workers have a process to themselves
+            jobs, args = self.jobs, (render_job, data, renderer_, as_text, True)
+        try:
+            result, filename, stats = await jobs.submit(owner, *args)
+        except QueueFull:
+            return await ctx.send("Too many images are being converted right now, try again later!")
+        self.stats.append(stats)
+        await self.cache.put_async(key, result, filename)
+        await ctx.send(file=File(BytesIO(result), filename=filename))
+
+    @command(name="asciistats")
+    async def job_stats(self, ctx):
+        if not self.stats:
+            return await ctx.send("No images have been converted yet.")
+        traced = [job for job in self.stats if job.peak_bytes is not None]
+        lines = [f"Last {len(self.stats)} jobs: {max(job.seconds for job in self.stats):.2f}s slowest, "
+                 f"{max(job.frames for job in self.stats)} frames most"]
+        if traced:
+            lines.append(f"Process pool ({len(traced)} jobs): "
+                         f"{max(job.peak_bytes for job in traced) / 2 ** 20:.1f}MiB peak traced, "
+                         f"{max(job.max_rss for job in traced) / 2 ** 20:.1f}MiB worker RSS")
+        cache = self.cache.stats
+        lines.append(f"Cache: {cache['hits']} memory hits, {cache['disk_hits']} disk hits, {cache['misses']} misses")
+        await ctx.send("\n".join(lines))
+
+
+def animate_job(data: bytes, renderer_: AsciiRenderer, submit: Callable[..., Future],
+                window: int) -> Tuple[bytes, str, JobStats]:
+    with JobStats().measure() as stats:
+        img = Image.open(BytesIO(data))
+        result = renderer_.animate(img, renderer_.get_invert(img), stats, submit, window).read()
+    return result, "ascii.webp", stats
+
 
+def render_job(data: bytes, renderer_: AsciiRenderer, as_text: bool = False,
+               trace: bool = False) -> Tuple[bytes, str, JobStats]:
+    with JobStats().measure(trace) as stats:
         img = Image.open(BytesIO(data))
-        inv = self.get_invert(img)
-        stringified = self.stringify_image(img, inv)
-        reimaged = self.string_to_png(stringified, inv)
-        await ctx.send(file=File(reimaged, filename="ascii.png"))
+        if not as_text and getattr(img, "is_animated", False):
+            result, filename = renderer_.animate(img, renderer_.get_invert(img), stats).read(), "ascii.webp"
+        else:
+            luma = renderer_.luma(img)
+            inv = renderer_.luma_invert(luma)
+            indices = renderer_.quantize_luma(luma, inv)
+            if as_text:
+                result, filename = renderer_.indices_to_string(indices).encode(), "ascii.txt"
+            else:
+                result, filename = renderer_.indices_to_png(indices, inv).read(), "ascii.png"
+    return result, filename, stats
 
 
 def setup(core: Bot):
-    core.add_cog(AsciiCog(core))
+    core.add_cog(AsciiCog())
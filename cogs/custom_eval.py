@@ -1,36 +1,93 @@
+import asyncio
 import contextlib
 import inspect
-import re
 from io import StringIO
-from textwrap import indent
 from traceback import format_exc
-from typing import Tuple, Any, Union, Optional
+from time import monotonic
+from typing import Dict, Tuple, Any, Union, Optional
 
 import discord
-from discord import Embed
+from discord import Embed, File, Message
 from discord.ext.commands import Context, command, Bot
 
 from core.formatters import EvalFormatter, SimpleEvalFormatter, IPythonEvalFormatter
+from core.repl import (OUTPUT, Session, SnippetTimeout, capture_stdout, compile_snippet, format_error,
+                       release_stdout, run_snippet)
+
+
+class StreamedOutput(StringIO):
+    """
+    Output of a running snippet, posted to the channel every `interval`
+    seconds. Each message is edited until it holds `limit` characters,
+    after which output continues in a new one.
+    """
+    def __init__(self, ctx: Context, interval: float = 1.0, limit: int = 1900):
+        super().__init__()
+        self.ctx = ctx
+        self.interval = interval
+        self.limit = limit
+
+        self.message: Optional[Message] = None
+        self.chunk = 0
+        self.sent = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        # A failed send or edit shouldn't hide the snippet's result; the
+        # output it didn't get to still ends up in the final message
+        with contextlib.suppress(Exception, asyncio.CancelledError):
+            await self.task
+
+    def unsent(self) -> str:
+        return self.getvalue()[self.sent:]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._push()
+
+    async def _push(self):
+        value = self.getvalue()
+        if len(value) == self.sent:
+            return
+
+        # At most one send or edit per interval, to stay within rate limits
+        text = value[self.chunk:self.chunk + self.limit]
+        if self.message is None:
+            self.message = await self.ctx.send(f"```\n{text}\n```")
+        else:
+            await self.message.edit(content=f"```\n{text}\n```")
+        self.sent = self.chunk + len(text)
 
-EVAL_FMT = """
-try:
-    with contextlib.redirect_stdout(self.buffer):
-{body}
-finally:
-    self.env.update(locals())
-""".strip()
+        if len(text) == self.limit:
+            self.chunk = self.sent
+            self.message = None
 
 
 class EvalCog:
-    def __init__(self, bot, fmt: Optional[EvalFormatter] = None):
-        self.buffer = StringIO()
+    def __init__(self, bot, fmt: Optional[EvalFormatter] = None, timeout: float = 60, stream_interval: float = 1.0,
+                 session_timeout: float = 3600, max_names: int = 50, max_bytes: int = 64 * 1024 * 1024):
         self.fmt = fmt or SimpleEvalFormatter()
         self.bot = bot
-        self.env = {}
-        self.init_env()
-
-    def init_env(self):
-        self.env = {
+        self.timeout = timeout
+        self.stream_interval = stream_interval
+        self.session_timeout = session_timeout
+        self.max_names = max_names
+        self.max_bytes = max_bytes
+        # Keyed by (channel id, user id)
+        self.sessions: Dict[Tuple[int, int], Session] = {}
+        # print() inside snippets goes to that snippet's own output
+        capture_stdout()
+
+    def __unload(self):
+        release_stdout()
+
+    def init_env(self) -> dict:
+        return {
             "bot": self.bot,
             "inspect": inspect,
             "contextlib": contextlib,
@@ -38,29 +95,37 @@ class EvalCog:
             "discord": discord,
         }
 
-    async def any_eval(self, stmt: str, env: dict) -> Any:
-        self.buffer.seek(0)
-        lines = [line.strip() for line in stmt.split("\n") if line.strip()]
-        stmt = "\n".join(lines)
-        self.env.update(env)
-        if len(lines) == 1 and not (';' in stmt or re.search(r"[^><!=~+\-\/*%]=[^=]", stmt)):  # make sure there's no assignment
-            try:
-                compile("_ = " + stmt, "<eval-repl>", "exec", ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
-                stmt = "_ = " + stmt + "\nif inspect.isawaitable(_):\n    _ = await _\nreturn _"
-            except SyntaxError:
-                pass
+    def session(self, ctx: Context) -> Session:
+        deadline = monotonic() - self.session_timeout
+        for key in [key for key, session in self.sessions.items() if session.last_used < deadline]:
+            del self.sessions[key]
 
-        _code = EVAL_FMT.format(body=indent(stmt, " "*8))
+        key = (ctx.channel.id, ctx.author.id)
+        if key not in self.sessions:
+            self.sessions[key] = Session(self.init_env(), self.max_names, self.max_bytes)
+        return self.sessions[key]
 
-        func = eval(compile(_code, "<eval-repl>", "exec", ast.PyCF_ALLOW_TOP_LEVEL_AWAIT), self.env)
+    async def any_eval(self, stmt: str, env: dict, output: StringIO, session: Session) -> Any:
+        # One run per session at a time, see Session
+        async with session.lock:
+            session.enter(env)
+            token = OUTPUT.set(output)
 
-        try:
-            res = await func()
-        except Exception:
-            lines = format_exc().split("\n")
-            lines = [lines[0], *lines[3:]]
-            self.buffer.write("\n".join(lines))
-            res = None
+            try:
+                res = await run_snippet(compile_snippet(stmt, session.env), self.timeout)
+                session.env["_"] = res
+            except SyntaxError:
+                output.write(format_exc(limit=0))
+                res = None
+            except SnippetTimeout as e:
+                output.write(str(e))
+                res = None
+            except Exception as e:
+                output.write(format_error(e))
+                res = None
+            finally:
+                OUTPUT.reset(token)
+                session.exit(env)
 
         return res
 
@@ -79,15 +144,19 @@ class EvalCog:
 
         return input_.strip(), ctx, True
 
-    async def do_eval(self, input_: str, context: Context) -> Union[str, Embed, Tuple[str, Embed]]:
+    async def do_eval(self, input_: str, context: Context) -> Union[str, Embed, Tuple[str, Union[Embed, File]]]:
         input_code, env, do_run = self.pre_process(input_, context)
         if do_run:
-            out = await self.any_eval(input_code, env)
-            self.buffer.seek(0)
-            printed = self.buffer.read()
-            self.buffer = StringIO()
+            output = StreamedOutput(context, self.stream_interval)
+            output.start()
+            try:
+                out = await self.any_eval(input_code, env, output, self.session(context))
+            finally:
+                await output.stop()
+            # Whatever was streamed already is left out of the final message
+            printed = output.unsent()
         else:
-            self.init_env()
+            self.sessions.pop((context.channel.id, context.author.id), None)
             return input_code
 
         return self.fmt.format(input_code, out, printed)
@@ -104,9 +173,20 @@ class EvalCog:
             await ctx.send(f"```py\n{res}\n```")
         elif isinstance(res, Embed):
             await ctx.send(embed=res)
+        elif isinstance(res, tuple) and isinstance(res[1], File):
+            await ctx.send(f"```py\n{res[0]}\n```", file=res[1])
         elif isinstance(res, tuple):
             await ctx.send(res[0], embed=res[1])
-        # TODO: Add support for attachments
+
+    @command(name="sessions")
+    # IMPORTANT: Add IS_OWNER check before using this code!
+    async def list_sessions(self, ctx: Context):
+        lines = [f"{'channel':>20} {'user':>20} {'names':>5} {'KiB':>8} {'runs':>5} {'idle':>6}"]
+        for (channel, user), session in self.sessions.items():
+            usage = session.usage()
+            lines.append(f"{channel:>20} {user:>20} {usage['names']:>5} {usage['bytes'] / 1024:>8.1f} "
+                         f"{usage['runs']:>5} {usage['idle']:>5}s")
+        await ctx.send("```\n{}\n```".format("\n".join(lines)))
 
 
 def setup(core: Bot):
@@ -1,4 +1,6 @@
+import asyncio
 from collections import defaultdict
+from functools import partial
 from typing import Dict, Type
 
 from discord import FFmpegPCMAudio, PCMAudio, AudioSource
@@ -6,26 +8,50 @@ from discord.ext.commands import group, Context, Bot
 from mart_music.async_ import MusicClient
 from mart_music.common import Song
 
+from core.music.cache import CachedMusicClient
 from core.music.player import Player
-from core.music.queues import QUEUE, Queue
+from core.music.queues import QUEUE, Queue, QueueClosed
 from core.music.sources import MartPCMAudio, MartFFmpegPCMAudio
 
 
 class MusicCog:
-    def __init__(self, core, queue_type: Type[Queue] = QUEUE.Chunked):
+    def __init__(self, core, queue_type: Type[Queue] = QUEUE.Chunked, client: MusicClient = None,
+                 dsp_config: Dict = None):
         self.core = core
         self._type = queue_type
-        self.client = MusicClient(core.config["music_token"])
+        # Players with the same config share a DSP server
+        self.dsp_config = dsp_config
+        # Shared by all guilds, so popular songs are only downloaded once
+        self.client = CachedMusicClient(client or MusicClient(core.config["music_token"]))
         self.players: Dict[str, Player] = {}
 
-    async def _play(self, ctx: Context, source: AudioSource):
-        if ctx.guild.id not in self.players:
-            self.players[ctx.guild.id] = Player(
-                await ctx.author.voice.channel.connect(reconnect=True),
-                self._type()
-            )
+    async def _connect(self, ctx: Context) -> Player:
+        player = self.players[ctx.guild.id] = Player(
+            await ctx.author.voice.channel.connect(reconnect=True),
+            self._type(),
+            self.dsp_config
+        )
+
+        def forget(_):
+            # A new player may have taken its place already
+            if self.players.get(ctx.guild.id) is player:
+                del self.players[ctx.guild.id]
+
+        # The player disconnects by itself once it has been idle a while
+        player.task.add_done_callback(forget)
+        return player
 
-        self.players[ctx.guild.id].play(source)
+    async def _play(self, ctx: Context, source: AudioSource):
+        while True:
+            player = self.players.get(ctx.guild.id)
+            if player is None:
+                player = await self._connect(ctx)
+            try:
+                return await player.play(source, requester_id=ctx.author.id)
+            except QueueClosed:
+                # It idled out and is still disconnecting; connect again
+                # once it's done
+                await asyncio.wait({player.task})
 
     @staticmethod
     def no_choice(ctx):
@@ -36,7 +62,7 @@ class MusicCog:
         pass
 
     @music.command()
-    def play(self, ctx: Context, *, song: str):
+    async def play(self, ctx: Context, *, song: str):
         results = await self.client.search(song)
 
         msg = "\n".join(f"{i+1}: {song.title} - {song.artist}" for i, song in enumerate(results))
@@ -60,12 +86,25 @@ class MusicCog:
 
         choice: Song = result[0]
 
+        # The file stays on disk until the source is cleaned up
+        path = await self.client.download(choice)
+        release = partial(self.client.release, choice)
         if choice.downloadable:
-            source = MartPCMAudio((await self.client.download(choice))[0], choice)
+            source = MartPCMAudio(path, choice, release)
         else:
-            source = MartFFmpegPCMAudio((await self.client.download(choice))[0], choice)
+            source = MartFFmpegPCMAudio(path, choice, release)
+
+        await self._play(ctx, source)
 
-        self.play(ctx, source)
+    @music.command()
+    async def stats(self, ctx: Context):
+        player = self.players.get(ctx.guild.id)
+        if player is None:
+            return await ctx.send("Nothing is playing.")
+        stats = player.stats
+        await ctx.send(f"Longest gap between songs: {stats['max_gap'] * 1000:.0f}ms\n"
+                       f"Slowest DSP frame: {stats['max_dsp_latency'] * 1000:.1f}ms, "
+                       f"{stats['dsp_over_budget']} frames over budget")
 
 
 def setup(core: Bot):
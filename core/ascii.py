@@ -0,0 +1,287 @@
+import resource
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future
+from functools import lru_cache
+from io import BytesIO
+from time import perf_counter
+from typing import Callable, Union, Iterator, Iterable, Optional
+from urllib.parse import urlparse
+from PIL import Image, ImageDraw as ID, ImageFont
+import numpy as np
+from webp import WebPAnimEncoder, WebPPicture, WebPAnimEncoderOptions, WebPConfig
+
+CHARSET = ' .,:;irsXA253hMHGS#9B&@'
+FONT = "assets/CourierNew.ttf"
+
+
+class JobStats:
+    """
+    Frame count, duration and measured memory of a single render job.
+
+    Memory is only measured for jobs run with `trace`, which is meant for
+    process pool workers running one job at a time. `peak_bytes` is then
+    the tracemalloc peak while the job ran, which covers NumPy buffers and
+    Python objects but not Pillow's or libwebp's own allocations, and
+    `max_rss` is the worker's resident high-water mark since it started.
+    Elsewhere both stay None: tracing in a shared process would slow down
+    and count every other thread's allocations, and concurrent jobs would
+    reset each other's peaks.
+    """
+    def __init__(self):
+        self.frames = 0
+        self.seconds = 0.0
+        self.peak_bytes: Optional[int] = None
+        self.max_rss: Optional[int] = None
+
+    def record(self):
+        self.frames += 1
+
+    @contextmanager
+    def measure(self, trace: bool = False):
+        start = perf_counter()
+        if trace:
+            tracemalloc.start()
+        try:
+            yield self
+        finally:
+            self.seconds = perf_counter() - start
+            if trace:
+                self.peak_bytes = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self.max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class AsciiRenderer:
+    """
+    Converts images to ascii art. All lookup tables and glyph metrics are
+    built once in __init__ and never modified afterwards, so a renderer can
+    be shared between threads. Pickling only sends the parameters; the
+    receiving process rebuilds (and caches) its own copy.
+    """
+    def __init__(self, width: int = 512, chars: str = CHARSET, font: str = FONT, font_size: int = 18,
+                 intensity: float = 1.2, image_scale: float = 0.5, width_correction: float = 7 / 4):
+        self.width = width
+        self.charset = chars
+        self.font_path = font
+        self.font_size = font_size
+        self.intensity = intensity
+        self.image_scale = image_scale
+        self.width_correction = width_correction
+
+        self.chars = np.asarray(list(chars))
+        self.font = ImageFont.truetype(font, font_size)
+        self.spacing = 4
+        self.columns = round(width * width_correction * image_scale)
+        self.row_scale = width * image_scale
+        self.char_bytes = np.frombuffer(chars.encode("latin-1"), dtype=np.uint8)
+        self.char_lut = np.zeros(256, dtype=np.uint8)
+        self.char_lut[self.char_bytes] = np.arange(self.chars.size)
+        self.atlas = self.build_atlas()
+        self.luma_lut = self.build_luma_lut()
+
+    @property
+    def params(self) -> tuple:
+        return (self.width, self.charset, self.font_path, self.font_size,
+                self.intensity, self.image_scale, self.width_correction)
+
+    def __reduce__(self):
+        return renderer, self.params
+
+    def resized(self, width: int) -> "AsciiRenderer":
+        return renderer(width, *self.params[1:])
+
+    def build_atlas(self) -> np.ndarray:
+        # Courier is monospaced, so every glyph fits the same cell; the cell
+        # height matches the line spacing ImageDraw uses for multiline text
+        default = ID.Draw(Image.new("RGB", (128, 128)))
+        cell_w = default.textsize("".join(self.chars), font=self.font)[0] // self.chars.size
+        cell_h = default.textsize("A", font=self.font)[1] + self.spacing
+
+        atlas = np.empty((self.chars.size, cell_h, cell_w), dtype=np.uint8)
+        for i, char in enumerate(self.chars):
+            cell = Image.new("L", (cell_w, cell_h), 255)
+            ID.Draw(cell).text((0, 0), char, 0, font=self.font)
+            atlas[i] = np.asarray(cell)
+        return atlas
+
+    def get_height(self, img: Image.Image) -> int:
+        w, h = img.size
+        return round(h * self.row_scale / w)
+
+    def build_luma_lut(self) -> np.ndarray:
+        # Maps normalized luma (0 = darkest, 255 = brightest) to a char index
+        scale = np.arange(256) / 255
+        return ((1.0 - scale) ** self.intensity * (self.chars.size - 1)).astype(np.uint8)
+
+    def luma(self, img: Image.Image) -> np.ndarray:
+        rgb = np.asarray(img.convert("RGB").resize((self.columns, self.get_height(img))))
+
+        # BT.601 weights in 8.8 fixed point; 255 * 256 still fits in uint16
+        luma = rgb[..., 0].astype(np.uint16) * 77
+        luma += rgb[..., 1].astype(np.uint16) * 150
+        luma += rgb[..., 2].astype(np.uint16) * 29
+        return (luma >> 8).astype(np.uint8)
+
+    @staticmethod
+    def luma_invert(luma: np.ndarray) -> bool:
+        # Invert when there are more pixels near the darkest value than
+        # near the brightest one
+        hist = np.bincount(luma.ravel(), minlength=256)
+        lo, hi = int(luma.min()), int(luma.max())
+        return bool(hist[max(hi - 5, 0):hi + 1].sum() < hist[lo:lo + 6].sum())
+
+    def get_invert(self, img: Image.Image) -> bool:
+        return self.luma_invert(self.luma(img))
+
+    def stringify(self, img: Image.Image, filename: str, stats: Optional[JobStats] = None) -> BytesIO:
+        file = urlparse(filename).path
+        inv = self.get_invert(img)
+        if file.endswith("gif"):
+            return self.animate(img, inv, stats)
+
+        elif any(file.endswith(x) for x in ("png", "jpg", "jpeg")):
+            indices = self.quantize_image(img, inv)
+            return self.indices_to_png(indices, inv)
+        raise Exception("Unsupported file type")
+
+    def animate(self, img: Image.Image, inv: bool = False, stats: Optional[JobStats] = None,
+                submit: Optional[Callable[..., Future]] = None, window: int = 1) -> BytesIO:
+        # Animations are rendered at half width, with that renderer's metrics
+        half = self.resized(self.width // 2)
+        duration = img.info['duration']
+        if submit is None:
+            images = (half.render_indices(frame, inv) for frame in half.quantize_gif(img, inv))
+        else:
+            images = half.map_frames(img, inv, submit, window)
+        return self.images_to_webp(images, duration, stats)
+
+    def map_frames(self, img: Image.Image, inv: bool, submit: Callable[..., Future],
+                   window: int) -> Iterator[Image.Image]:
+        # Compositing depends on the previous frame so it stays here, in
+        # order; everything after it is independent per frame and is handed
+        # to `submit` (e.g. Executor.submit). At most `window` frames are in
+        # flight at once.
+        pending = deque()
+        for frame in self.iter_frames(img):
+            pending.append(submit(render_frame, np.asarray(frame), self, inv))
+            if len(pending) >= window:
+                yield Image.fromarray(pending.popleft().result(), "L").convert("RGB")
+
+        while pending:
+            yield Image.fromarray(pending.popleft().result(), "L").convert("RGB")
+
+    @staticmethod
+    def iter_frames(img: Image.Image) -> Iterator[Image.Image]:
+        current = img.convert("RGBA")
+        while True:
+            yield current.convert("RGB")
+            try:
+                img.seek(img.tell()+1)
+            except EOFError:
+                return
+            current = Image.alpha_composite(current, img.convert('RGBA'))
+
+    def quantize_gif(self, img: Image.Image, inv: bool = False) -> Iterator[np.ndarray]:
+        return (self.quantize_image(frame, inv) for frame in self.iter_frames(img))
+
+    def stringify_gif(self, img: Image.Image, inv: bool = False) -> Iterator[str]:
+        return (self.indices_to_string(frame) for frame in self.quantize_gif(img, inv))
+
+    def indices_to_gif(self, frames: Iterable[np.ndarray], duration: float, inv: bool = False,
+                       stats: Optional[JobStats] = None) -> BytesIO:
+        return self.images_to_webp((self.render_indices(frame, inv) for frame in frames), duration, stats)
+
+    @staticmethod
+    def images_to_webp(images: Iterable[Image.Image], duration: float, stats: Optional[JobStats] = None,
+                       lossless_preset: int = 1, minimize_size: bool = False) -> BytesIO:
+        # Frames are pulled and encoded one at a time so memory use doesn't
+        # depend on the animation length.
+        # Encoding is serial and dominates the job. The frames are two-tone
+        # glyphs, which lossless compresses both faster and smaller than the
+        # lossy default; minimize_size mostly costs time on top of that.
+        enc = None
+        config = WebPConfig.new(lossless=True, lossless_preset=lossless_preset)
+        t = 0
+        for img in images:
+            if enc is None:
+                enc = WebPAnimEncoder.new(*img.size, WebPAnimEncoderOptions.new(minimize_size=minimize_size))
+            if stats is not None:
+                stats.record()
+            enc.encode_frame(WebPPicture.from_pil(img), round(t), config)
+            t += duration
+
+        if enc is None:
+            raise Exception("Animation has no frames")
+
+        b = BytesIO()
+        data = enc.assemble(round(t))
+        b.write(data.buffer())
+
+        b.seek(0)
+        return b
+
+    def string_to_gif(self, frames: Iterable[str], duration: float, inv: bool = False) -> BytesIO:
+        return self.indices_to_gif((self.string_to_indices(frame) for frame in frames), duration, inv)
+
+    def quantize_image(self, img: Image.Image, inv: bool = False) -> np.ndarray:
+        return self.quantize_luma(self.luma(img), inv)
+
+    def quantize_luma(self, luma: np.ndarray, inv: bool = False) -> np.ndarray:
+        if inv:
+            luma = 255 - luma
+        lo, hi = int(luma.min()), int(luma.max())
+        # Stretch to the full 0-255 range; (luma - lo) * 255 fits in uint16
+        norm = (luma - np.uint8(lo)).astype(np.uint16) * np.uint16(255) // np.uint16(max(hi - lo, 1))
+        return self.luma_lut[norm]
+
+    def stringify_image(self, img: Image.Image, inv: bool = False) -> str:
+        return self.indices_to_string(self.quantize_image(img, inv))
+
+    def indices_to_string(self, indices: np.ndarray) -> str:
+        rows = self.char_bytes[indices]
+        newlines = np.full((rows.shape[0], 1), ord("\n"), dtype=np.uint8)
+        return np.hstack((rows, newlines)).tobytes()[:-1].decode("latin-1")
+
+    def string_to_indices(self, ascii_: str) -> np.ndarray:
+        lines = ascii_.split("\n")
+        raw = np.frombuffer("".join(lines).encode("latin-1"), dtype=np.uint8)
+        return self.char_lut[raw].reshape(len(lines), len(lines[0]))
+
+    def render_indices(self, indices: np.ndarray, inv: bool = False) -> Image.Image:
+        return Image.fromarray(self.render_pixels(indices, inv), "L").convert("RGB")
+
+    def render_pixels(self, indices: np.ndarray, inv: bool = False) -> np.ndarray:
+        rows, cols = indices.shape
+        _, cell_h, cell_w = self.atlas.shape
+        # (rows, cols, cell_h, cell_w) -> (rows, cell_h, cols, cell_w)
+        pixels = self.atlas[indices].transpose(0, 2, 1, 3).reshape(rows * cell_h, cols * cell_w)
+        # ImageDraw doesn't pad below the last line
+        pixels = pixels[:rows * cell_h - self.spacing]
+        if inv:
+            pixels = 255 - pixels
+        return pixels
+
+    def string_to_png(self, ascii_: str, inv: bool = False, as_img: bool = False) -> Union[BytesIO, Image.Image]:
+        return self.indices_to_png(self.string_to_indices(ascii_), inv, as_img)
+
+    def indices_to_png(self, indices: np.ndarray, inv: bool = False,
+                       as_img: bool = False) -> Union[BytesIO, Image.Image]:
+        image = self.render_indices(indices, inv)
+        if as_img:
+            return image
+        fp = BytesIO()
+        image.save(fp, format="png")
+        fp.seek(0)
+        return fp
+
+
+@lru_cache(maxsize=16)
+def renderer(*params) -> AsciiRenderer:
+    return AsciiRenderer(*params)
+
+
+def render_frame(frame: np.ndarray, renderer_: AsciiRenderer, inv: bool) -> np.ndarray:
+    # Pool worker for AsciiRenderer.map_frames
+    return renderer_.render_pixels(renderer_.quantize_image(Image.fromarray(frame), inv), inv)
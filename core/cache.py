@@ -0,0 +1,224 @@
+import asyncio
+import os
+from collections import OrderedDict
+from hashlib import sha256
+from typing import Dict, Optional, Tuple
+
+
+class TieredCache:
+    """
+    LRU cache of files, in memory in front of a size-bounded disk store.
+
+    The index is not thread-safe and belongs to one thread (the event
+    loop). Only `read`, `write` and `touch` do no bookkeeping, so they can
+    run in an executor; `get_async` and `put_async` do just that.
+    """
+    def __init__(self, directory: str, max_memory: int = 32 * 1024 * 1024, max_disk: int = 512 * 1024 * 1024):
+        self.directory = directory
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+
+        self.memory: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+        self.memory_size = 0
+        self.disk: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self.disk_size = 0
+        # Files handed out by `path` that someone still reads from
+        self.pinned: Dict[str, int] = {}
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def key(digest: str, **params) -> str:
+        # `digest` identifies the input, e.g. a content hash
+        key = sha256(digest.encode())
+        key.update(repr(sorted(params.items())).encode())
+        return key.hexdigest()
+
+    def _scan(self):
+        # Rebuild the disk index, least recently used first
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+
+        for _, name, size in sorted(entries):
+            key, _, filename = name.partition("-")
+            self.disk[key] = (filename, size)
+            self.disk_size += size
+
+    def _path(self, key: str, filename: str) -> str:
+        return os.path.join(self.directory, f"{key}-{filename}")
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        if key in self.disk:
+            filename, _ = self.disk[key]
+            return self._read_done(key, filename, self.read(self._path(key, filename)))
+
+        self.misses += 1
+        return None
+
+    async def get_async(self, key: str) -> Optional[Tuple[bytes, str]]:
+        """ Like `get`, but reads from disk in the default executor """
+        if key in self.memory or key not in self.disk:
+            return self.get(key)
+
+        filename, _ = self.disk[key]
+        path = self._path(key, filename)
+        data = await asyncio.get_event_loop().run_in_executor(None, self.read, path)
+        return self._read_done(key, filename, data)
+
+    def _read_done(self, key: str, filename: str, data: Optional[bytes]) -> Optional[Tuple[bytes, str]]:
+        if data is None:
+            # Gone from disk; unless it has been replaced in the meantime
+            if self.disk.get(key, (None,))[0] == filename:
+                self._evict_disk(key)
+            self.misses += 1
+            return None
+
+        if key in self.disk:
+            self.disk.move_to_end(key)
+        self.disk_hits += 1
+        self._store_memory(key, data, filename)
+        return data, filename
+
+    @classmethod
+    def read(cls, path: str) -> Optional[bytes]:
+        """ Reads and touches a file, returning None if it doesn't exist """
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        cls.touch(path)
+        return data
+
+    def path(self, key: str, touch: bool = True) -> Optional[str]:
+        """
+        Like `get`, but returns the file on disk instead of reading it.
+
+        Without `touch` the disk isn't accessed at all; the caller should
+        `touch` the path itself so it's still recent after a restart.
+        """
+        if key in self.disk:
+            filename, _ = self.disk[key]
+            path = self._path(key, filename)
+            if touch and not self.touch(path):
+                self._evict_disk(key)
+            else:
+                self.disk.move_to_end(key)
+                self.disk_hits += 1
+                return path
+
+        self.misses += 1
+        return None
+
+    @staticmethod
+    def touch(path: str) -> bool:
+        """ Marks a file as recently used for `_scan`, returning whether it still exists """
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key: str, data: bytes, filename: str) -> Optional[str]:
+        """ Returns the path the data was stored at, if it fit on disk """
+        self._store_memory(key, data, filename)
+
+        if key in self.disk:
+            return self._path(key, self.disk[key][0])
+        if len(data) > self.max_disk:
+            return None
+        self.write(key, data, filename)
+        return self.add(key, filename, len(data))
+
+    async def put_async(self, key: str, data: bytes, filename: str) -> Optional[str]:
+        """ Like `put`, but writes to disk in the default executor """
+        self._store_memory(key, data, filename)
+
+        if key in self.disk:
+            return self._path(key, self.disk[key][0])
+        if len(data) > self.max_disk:
+            return None
+        await asyncio.get_event_loop().run_in_executor(None, self.write, key, data, filename)
+        return self.add(key, filename, len(data))
+
+    def write(self, key: str, data: bytes, filename: str) -> str:
+        """ Writes the file for `key` without indexing it, see `add` """
+        path = self._path(key, filename)
+        try:
+            with open(path, "wb") as f:
+                f.write(data)
+        except BaseException:
+            # Don't leave a partial file for `_scan` to pick up
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return path
+
+    def add(self, key: str, filename: str, size: int) -> str:
+        """ Indexes a file stored with `write`, evicting others to make room """
+        if key not in self.disk:
+            self.disk[key] = (filename, size)
+            self.disk_size += size
+            self._trim_disk()
+        return self._path(key, self.disk[key][0])
+
+    def pin(self, key: str):
+        """ Keeps the file for `key` on disk until a matching `unpin` """
+        self.pinned[key] = self.pinned.get(key, 0) + 1
+
+    def unpin(self, key: str):
+        if self.pinned.get(key, 0) > 1:
+            self.pinned[key] -= 1
+        else:
+            self.pinned.pop(key, None)
+            self._trim_disk()
+
+    def _trim_disk(self):
+        # Pinned files are skipped, so the store can stay over budget until
+        # they are released
+        if self.disk_size <= self.max_disk:
+            return
+        for key in [key for key in self.disk if key not in self.pinned]:
+            self._evict_disk(key)
+            if self.disk_size <= self.max_disk:
+                return
+
+    def _store_memory(self, key: str, data: bytes, filename: str):
+        if key in self.memory or len(data) > self.max_memory:
+            return
+        self.memory[key] = (data, filename)
+        self.memory_size += len(data)
+        while self.memory_size > self.max_memory:
+            _, (old, _) = self.memory.popitem(last=False)
+            self.memory_size -= len(old)
+
+    def _evict_disk(self, key: str):
+        filename, size = self.disk.pop(key)
+        self.disk_size -= size
+        try:
+            os.remove(self._path(key, filename))
+        except FileNotFoundError:
+            pass
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_bytes": self.memory_size,
+            "disk_bytes": self.disk_size,
+        }
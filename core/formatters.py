@@ -1,22 +1,157 @@
+import reprlib
 from abc import ABC, abstractmethod
+from collections import deque
+from collections.abc import Mapping, MappingView, Sequence, Set
+from io import BytesIO
 from pprint import pformat
-from typing import Any, Tuple, Union
+from typing import Any, Iterable, Optional, Tuple, Union
 
-from discord import Embed
+from discord import Embed, File
+
+
+class BoundedRepr(reprlib.Repr):
+    """
+    reprlib.Repr that stops producing output once about `budget`
+    characters have been written, so huge objects are never fully walked.
+
+    Containers are shown in iteration order rather than sorted. Anything
+    that is a Mapping, Sequence, Set or dict view is bounded the same way,
+    subclasses included, at the cost of their own __repr__.
+    """
+    # Handled by the repr_* methods below
+    BUILTINS = (list, tuple, set, frozenset, deque, dict)
+
+    def __init__(self, budget: int = 2000, items: int = 100, depth: int = 6):
+        super().__init__()
+        self.budget = budget
+        self.items = items
+        self.maxlevel = depth
+        self.maxarray = items
+        self.maxstring = self.maxlong = self.maxother = budget
+
+        self.used = 0
+        self.truncated = False
+
+    def repr(self, x: Any) -> str:
+        self.used = 0
+        self.truncated = False
+        return super().repr(x)
+
+    def repr1(self, x: Any, level: int) -> str:
+        used = self.used
+        out = self.repr_collection(x, level)
+        if out is None:
+            out = super().repr1(x, level)
+        if self.used == used:
+            # Only count leaves; containers are the sum of their items
+            self.used += len(out)
+            self.truncated |= len(out) >= self.budget
+        return out
+
+    def _join(self, items: Iterable, level: int, left: str, right: str, trail: str = "") -> str:
+        parts = []
+        for item in items:
+            if level <= 0 or len(parts) >= self.items or self.used >= self.budget:
+                parts.append("...")
+                self.truncated = True
+                break
+            parts.append(item(level - 1) if callable(item) else self.repr1(item, level - 1))
+            self.used += 2
+        return f"{left}{', '.join(parts)}{trail if len(parts) == 1 else ''}{right}"
+
+    def repr_collection(self, x: Any, level: int) -> Optional[str]:
+        # reprlib dispatches on the exact type name, so OrderedDict, Counter,
+        # dict views and subclasses would otherwise get a full builtins.repr
+        if type(x) in self.BUILTINS or isinstance(x, (str, bytes, bytearray, range, memoryview)):
+            return None
+        name = type(x).__name__
+        if isinstance(x, Mapping):
+            return f"{name}({self.repr_dict(x, level)})"
+        if isinstance(x, (Sequence, Set, MappingView)):
+            return self._join(x, level, f"{name}([", "])")
+        return None
+
+    def repr_list(self, x: list, level: int) -> str:
+        return self._join(x, level, "[", "]")
+
+    def repr_tuple(self, x: tuple, level: int) -> str:
+        return self._join(x, level, "(", ")", ",")
+
+    def repr_set(self, x: set, level: int) -> str:
+        return self._join(x, level, "{", "}") if x else "set()"
+
+    def repr_frozenset(self, x: frozenset, level: int) -> str:
+        return self._join(x, level, "frozenset({", "})") if x else "frozenset()"
+
+    def repr_deque(self, x: deque, level: int) -> str:
+        return self._join(x, level, "deque([", "])")
+
+    def repr_dict(self, x: Mapping, level: int) -> str:
+        def pair(key, value):
+            return lambda level_: f"{self.repr1(key, level_)}: {self.repr1(value, level_)}"
+        return self._join((pair(k, v) for k, v in x.items()), level, "{", "}")
+
+
+def head_tail(text: str, chars: int, lines: Optional[int] = None) -> Tuple[str, bool]:
+    """
+    Keeps the start and end of `text`: `lines` lines of each if it has
+    more than twice that, and at most `chars` characters overall.
+    """
+    truncated = False
+    if lines is not None:
+        # Locate the head and tail by searching, instead of splitting every line
+        head = -1
+        for _ in range(lines):
+            head = text.find("\n", head + 1)
+            if head == -1:
+                break
+        tail = len(text)
+        for _ in range(lines):
+            tail = text.rfind("\n", 0, tail)
+            if tail == -1:
+                break
+        if head != -1 and tail != -1 and tail > head:
+            text = f"{text[:head]}\n...{text[tail:]}"
+            truncated = True
+
+    if len(text) > chars:
+        half = max(chars - 5, 0) // 2
+        text = f"{text[:half]}\n...\n{text[len(text) - half:]}"
+        truncated = True
+    return text, truncated
 
 
 class EvalFormatter(ABC):
+    """
+    Output past `limit` characters is cut down for the message, with the
+    full version (up to `file_limit` characters) attached as a file.
+    """
+    def __init__(self, limit: int = 1900, file_limit: int = 256 * 1024):
+        self.limit = limit
+        self.file_limit = file_limit
+
     @abstractmethod
-    def format(self, input_: str, output: Any, printed: str) -> Union[str, Embed, Tuple[str, Embed]]:
+    def format(self, input_: str, output: Any, printed: str) -> Union[str, Embed, Tuple[str, Union[Embed, File]]]:
         ...
 
     @abstractmethod
     def exit(self, input_: str) -> str:
         pass
 
+    def bounded_repr(self, output: Any, budget: int, items: int = 100) -> Tuple[str, bool]:
+        formatter = BoundedRepr(budget, items)
+        text = formatter.repr(output)
+        return text, formatter.truncated
+
+    def overflow(self, text: str, parts: list) -> Tuple[str, File]:
+        """ Attaches `parts` in full, capped at `file_limit` characters """
+        full, _ = head_tail("\n".join(parts), self.file_limit)
+        text, _ = head_tail(text, self.limit)
+        return text, File(BytesIO(full.encode()), "output.txt")
+
 
 class SimpleEvalFormatter(EvalFormatter):
-    def format(self, input_: str, output: Any, printed: str) -> Union[str, Embed, Tuple[str, Embed]]:
+    def format(self, input_: str, output: Any, printed: str) -> Union[str, Embed, Tuple[str, Union[Embed, File]]]:
         lines = input_.split("\n")
         line_start = ">>> " + lines[0]
         other_lines = "\n".join(
@@ -29,37 +164,49 @@ class SimpleEvalFormatter(EvalFormatter):
         args = [line_start]
         if other_lines:
             args.append(other_lines)
+        full = args[:]
+        truncated = False
         if printed:
+            full.append(printed)
+            printed, truncated = head_tail(printed, self.limit // 2)
             args.append(printed)
         if output is not None:
-            args.append(repr(output))
             if isinstance(output, Embed):
-                args[-1] = "<Embed>"
+                args.append("<Embed>")
                 return "\n".join(args), output
 
-        return "\n".join(
+            budget = max(self.limit - sum(map(len, args)), self.limit // 4)
+            out, cut = self.bounded_repr(output, budget)
+            args.append(out)
+            if cut:
+                truncated = True
+                out, _ = self.bounded_repr(output, self.file_limit, self.file_limit)
+            full.append(out)
+
+        text = "\n".join(
             args
         )
+        if truncated or len(text) > self.limit:
+            return self.overflow(text, full)
+        return text
 
     def exit(self, input_: str):
         return f">>> {input_}\nInterpreter reset!"
 
 
 class IPythonEvalFormatter(EvalFormatter):
-    def __init__(self, pretty: bool = True, max_lines: int = 10):
+    def __init__(self, pretty: bool = True, max_lines: int = 10, **kwargs):
+        super().__init__(**kwargs)
         self.line_no = 1
         self.pretty = pretty
         self.max_lines = max_lines
 
-    def truncate(self, text: str) -> str:
-        if text.count("\n") > self.max_lines:
-            lines = text.split("\n")
-            return "\n".join(
-                (*lines[:3], "...", *lines[-3:])
-            )
-        return text
+    def truncate(self, text: str) -> Tuple[str, bool]:
+        if text.count("\n", 0, self.limit * 4) > self.max_lines:
+            return head_tail(text, self.limit // 2, 3)
+        return head_tail(text, self.limit // 2)
 
-    def format(self, input_: str, output: Any, printed: str) -> Union[str, Embed, Tuple[str, Embed]]:
+    def format(self, input_: str, output: Any, printed: str) -> Union[str, Embed, Tuple[str, Union[Embed, File]]]:
         lines = input_.split("\n")
         line_start = f"In [{self.line_no}]: " + lines[0]
         indent = len(str(self.line_no))
@@ -69,24 +216,41 @@ class IPythonEvalFormatter(EvalFormatter):
                                         else line[6:].strip())
             for line in lines[1:]
         )
-        out_line = f"Out[{self.line_no}]: " + (pformat(output, compact=True, width=60)
-                                               if self.pretty else repr(output))
+        out_prefix = f"Out[{self.line_no}]: "
         self.line_no += 1
 
         args = [line_start]
         if other_lines:
             args.append(other_lines)
+        full = args[:]
+        truncated = False
         if printed:
-            args.append(self.truncate(printed.strip()))
+            full.append(printed.strip())
+            printed, truncated = self.truncate(printed.strip())
+            args.append(printed)
         if output is not None:
-            args.append(self.truncate(out_line))
             if isinstance(output, Embed):
-                args[-1] = f"Out[{self.line_no-1}]: <Embed>"
+                args.append(out_prefix + "<Embed>")
                 return "\n".join(args), output
 
-        return "\n".join(
+            out, cut = self.bounded_repr(output, self.limit)
+            if not cut and self.pretty:
+                # Small enough to have been walked in full, so pformat is cheap
+                out = pformat(output, compact=True, width=60)
+            out_line, cut_lines = self.truncate(out_prefix + out)
+            args.append(out_line)
+            if cut or cut_lines:
+                truncated = True
+                if cut:
+                    out, _ = self.bounded_repr(output, self.file_limit, self.file_limit)
+            full.append(out_prefix + out)
+
+        text = "\n".join(
             args
         )
+        if truncated or len(text) > self.limit:
+            return self.overflow(text, full)
+        return text
 
     def exit(self, input_: str):
         prefix = f"In [{self.line_no}]: "
@@ -0,0 +1,115 @@
+import asyncio
+from hashlib import sha256
+from tempfile import SpooledTemporaryFile
+from typing import Dict, Tuple
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+
+
+class FetchError(Exception):
+    pass
+
+
+class Fetched:
+    """
+    A downloaded body, spooled to disk past `spool_size` bytes.
+
+    Concurrent fetches of the same URL share one Fetched; each of them
+    counts as a user from the moment it starts waiting, and the buffer is
+    closed once every one of them has called `close`.
+    """
+    def __init__(self, buffer: SpooledTemporaryFile, digest: str = "", size: int = 0):
+        self.buffer = buffer
+        self.digest = digest
+        self.size = size
+        self.users = 0
+
+    def __enter__(self) -> "Fetched":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self) -> SpooledTemporaryFile:
+        self.buffer.seek(0)
+        return self.buffer
+
+    def read(self) -> bytes:
+        return self.open().read()
+
+    def close(self):
+        self.users -= 1
+        if self.users <= 0:
+            self.buffer.close()
+
+
+class Fetcher:
+    """ Shared, connection-pooled HTTP fetcher with a body size limit """
+    def __init__(self, max_size: int = 8 * 1024 * 1024, timeout: float = 15, connections: int = 16,
+                 spool_size: int = 1024 * 1024, chunk_size: int = 64 * 1024, session: ClientSession = None):
+        self.max_size = max_size
+        self.timeout = ClientTimeout(total=timeout, sock_connect=timeout / 3)
+        self.connections = connections
+        self.spool_size = spool_size
+        self.chunk_size = chunk_size
+        self.session = session
+        self.in_flight: Dict[str, Tuple[Fetched, asyncio.Future]] = {}
+
+    def _session(self) -> ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = ClientSession(connector=TCPConnector(limit=self.connections), timeout=self.timeout)
+        return self.session
+
+    async def fetch(self, url: str) -> Fetched:
+        """ The caller has to `close` the result, even if it's shared """
+        # Concurrent requests for the same URL share a single download
+        if url not in self.in_flight:
+            fetched = Fetched(SpooledTemporaryFile(max_size=self.spool_size))
+            future = asyncio.ensure_future(self._fetch(url, fetched))
+            future.add_done_callback(lambda _: self.in_flight.pop(url, None))
+            self.in_flight[url] = (fetched, future)
+        fetched, future = self.in_flight[url]
+        # Counted before waiting, so nobody can close the buffer under us
+        fetched.users += 1
+        try:
+            await asyncio.shield(future)
+        except BaseException:
+            fetched.close()
+            if fetched.users <= 0:
+                # Nobody else wants it any more
+                future.cancel()
+            raise
+        return fetched
+
+    async def _fetch(self, url: str, fetched: Fetched) -> Fetched:
+        buffer = fetched.buffer
+        digest = sha256()
+        size = 0
+        try:
+            async with self._session().get(url) as response:
+                if response.status != 200:
+                    raise FetchError(f"Server responded with {response.status}.")
+                if (response.content_length or 0) > self.max_size:
+                    raise FetchError("File is too large.")
+
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    size += len(chunk)
+                    # Content-Length can be missing or wrong, so check as we go
+                    if size > self.max_size:
+                        raise FetchError("File is too large.")
+                    digest.update(chunk)
+                    buffer.write(chunk)
+        except (ClientError, asyncio.TimeoutError) as e:
+            buffer.close()
+            raise FetchError(f"Could not download file: {e}") from e
+        except FetchError:
+            buffer.close()
+            raise
+
+        fetched.digest = digest.hexdigest()
+        fetched.size = size
+        return fetched
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
@@ -0,0 +1,99 @@
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, Future
+from functools import partial
+from typing import Any, Callable, Deque, Dict, Hashable, Tuple
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """ Bounded job queue in front of an executor, round-robin across keys """
+    def __init__(self, executor: Executor, max_workers: int, max_pending: int = 16):
+        self.executor = executor
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pending: Dict[Hashable, Deque[Tuple[asyncio.Future, Callable, tuple]]] = OrderedDict()
+        self.queued = 0
+        self.running = 0
+
+    def __len__(self) -> int:
+        return self.queued
+
+    def submit(self, key: Hashable, func: Callable, *args: Any) -> asyncio.Future:
+        if self.queued >= self.max_pending:
+            raise QueueFull("Too many pending jobs.")
+        return self._enqueue(key, func, args)
+
+    def submit_threadsafe(self, loop: asyncio.AbstractEventLoop, key: Hashable, func: Callable, *args: Any) -> Future:
+        """
+        Queues a job from another thread, e.g. to fan one job's work out
+        over the pool. These share the workers and the round-robin with
+        everything else, but don't count towards `max_pending`; the caller
+        has to bound how many it has in flight.
+        """
+        result = Future()
+
+        def copy(future: asyncio.Future):
+            if future.cancelled():
+                result.cancel()
+            elif future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(future.result())
+
+        def enqueue():
+            self._enqueue(key, func, args).add_done_callback(copy)
+
+        loop.call_soon_threadsafe(enqueue)
+        return result
+
+    def _enqueue(self, key: Hashable, func: Callable, args: tuple) -> asyncio.Future:
+        future = asyncio.get_event_loop().create_future()
+        self.pending.setdefault(key, deque()).append((future, func, args))
+        self.queued += 1
+        self._dispatch()
+        return future
+
+    def _next(self) -> Tuple[asyncio.Future, Callable, tuple]:
+        # Take one job from the key that has waited the longest, then move
+        # that key to the back so a single guild can't hog the workers
+        key, jobs = next(iter(self.pending.items()))
+        job = jobs.popleft()
+        del self.pending[key]
+        if jobs:
+            self.pending[key] = jobs
+        self.queued -= 1
+        return job
+
+    def _dispatch(self):
+        loop = asyncio.get_event_loop()
+        while self.running < self.max_workers and self.pending:
+            future, func, args = self._next()
+            if future.cancelled():
+                continue
+
+            self.running += 1
+            inner = loop.run_in_executor(self.executor, func, *args)
+            inner.add_done_callback(partial(self._done, future))
+
+    def _done(self, future: asyncio.Future, inner: asyncio.Future):
+        self.running -= 1
+        if not future.cancelled():
+            if inner.cancelled():
+                future.cancel()
+            elif inner.exception() is not None:
+                future.set_exception(inner.exception())
+            else:
+                future.set_result(inner.result())
+        self._dispatch()
+
+    def shutdown(self):
+        for jobs in self.pending.values():
+            for future, _, _ in jobs:
+                future.cancel()
+        self.pending.clear()
+        self.queued = 0
+        self.executor.shutdown(wait=False)
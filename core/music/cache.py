@@ -0,0 +1,95 @@
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Tuple
+
+from mart_music.common import Song
+
+from core.cache import TieredCache
+
+
+class CachedMusicClient:
+    """
+    Wraps a MusicClient with a TTL'd LRU of search results, a size-bounded
+    disk store of downloads keyed by song id, and request coalescing so
+    concurrent calls for the same search or song share one request.
+
+    Downloads are handed out as paths into the disk store, so nothing is
+    held in memory while songs wait in a queue. Each path stays on disk
+    until it is given back with `release`.
+    """
+    def __init__(self, client, directory: str = ".cache/music", search_ttl: float = 600, max_searches: int = 512,
+                 max_disk: int = 2 * 1024 * 1024 * 1024):
+        self.client = client
+        self.search_ttl = search_ttl
+        self.max_searches = max_searches
+        self.searches: "OrderedDict[str, Tuple[float, List[Song]]]" = OrderedDict()
+        self.downloads = TieredCache(directory, 0, max_disk)
+        self.in_flight: Dict[Hashable, asyncio.Future] = {}
+        self.loop = asyncio.get_event_loop()
+
+        self.search_hits = 0
+        self.search_misses = 0
+
+    async def _coalesce(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        if key not in self.in_flight:
+            self.in_flight[key] = asyncio.ensure_future(factory())
+            self.in_flight[key].add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return await asyncio.shield(self.in_flight[key])
+
+    async def search(self, query: str) -> List[Song]:
+        key = " ".join(query.lower().split())
+        cached = self.searches.get(key)
+        if cached is not None and cached[0] > monotonic():
+            self.searches.move_to_end(key)
+            self.search_hits += 1
+            return cached[1]
+
+        self.search_misses += 1
+        return await self._coalesce(("search", key), lambda: self._search(key, query))
+
+    async def _search(self, key: str, query: str) -> List[Song]:
+        results = await self.client.search(query)
+        self.searches[key] = (monotonic() + self.search_ttl, results)
+        self.searches.move_to_end(key)
+        while len(self.searches) > self.max_searches:
+            self.searches.popitem(last=False)
+        return results
+
+    async def download(self, song: Song) -> str:
+        key = TieredCache.key(str(song.id))
+        # Pinned up front, so other downloads can't evict it before we return
+        self.downloads.pin(key)
+        try:
+            path = self.downloads.path(key, touch=False)
+            if path is None:
+                path = await self._coalesce(("download", key), lambda: self._download(key, song))
+            else:
+                self.loop.run_in_executor(None, self.downloads.touch, path)
+        except BaseException:
+            self.downloads.unpin(key)
+            raise
+        return path
+
+    def release(self, song: Song):
+        """ Lets the store evict a downloaded song again; safe to call from any thread """
+        self.loop.call_soon_threadsafe(self.downloads.unpin, TieredCache.key(str(song.id)))
+
+    async def _download(self, key: str, song: Song) -> str:
+        buffer = (await self.client.download(song))[0]
+        # Written straight from the buffer, off the loop; only indexing
+        # the finished file happens here
+        with buffer, buffer.getbuffer() as data:
+            size = data.nbytes
+            if size > self.downloads.max_disk:
+                raise ValueError(f"{song.title} is too large to cache.")
+            await self.loop.run_in_executor(None, self.downloads.write, key, data, "audio")
+        return self.downloads.add(key, "audio", size)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "search_hits": self.search_hits,
+            "search_misses": self.search_misses,
+            **{f"download_{name}": value for name, value in self.downloads.stats.items()},
+        }
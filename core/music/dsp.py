@@ -0,0 +1,85 @@
+import json
+from hashlib import sha256
+from time import monotonic
+from typing import Dict, Optional
+
+from izunadsp import DSPServer
+
+
+class PooledServer:
+    """ A DSPServer shared by every player with the same config, started on first use """
+    def __init__(self, key: str, config: Dict):
+        self.key = key
+        self.config = config
+        self.server: Optional[DSPServer] = None
+
+        self.players = 0
+        self.managers = 0
+        self.idle_since: Optional[float] = monotonic()
+
+    def start(self) -> DSPServer:
+        if self.server is None:
+            self.server = DSPServer()
+            for part, settings in self.config.items():
+                for attribute, value in settings.items():
+                    self.server.config(part, attribute, value)
+        return self.server
+
+    def get_manager(self):
+        self.managers += 1
+        return self.start().get_manager()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "started": self.server is not None,
+            "players": self.players,
+            "managers": self.managers,
+        }
+
+
+class DSPPool:
+    """
+    Process-wide pool of DSP servers, deduplicated by config.
+
+    Servers nobody has used for `idle_timeout` seconds are dropped the
+    next time a player releases one.
+    """
+    def __init__(self, idle_timeout: float = 600):
+        self.idle_timeout = idle_timeout
+        self.servers: Dict[str, PooledServer] = {}
+
+    @staticmethod
+    def key(config: Optional[Dict]) -> str:
+        return sha256(json.dumps(config or {}, sort_keys=True, default=repr).encode()).hexdigest()
+
+    def acquire(self, config: Dict = None) -> PooledServer:
+        key = self.key(config)
+        if key not in self.servers:
+            self.servers[key] = PooledServer(key, config or {})
+        server = self.servers[key]
+        server.players += 1
+        server.idle_since = None
+        return server
+
+    def release(self, server: PooledServer):
+        server.players -= 1
+        if not server.players:
+            server.idle_since = monotonic()
+        self.reap()
+
+    def reap(self) -> int:
+        """ Drop servers that have been idle too long, returning how many were dropped """
+        deadline = monotonic() - self.idle_timeout
+        idle = [key for key, server in self.servers.items()
+                if server.idle_since is not None and server.idle_since <= deadline]
+        for key in idle:
+            del self.servers[key]
+        return len(idle)
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {key: server.stats for key, server in self.servers.items()}
+
+
+POOL = DSPPool()
@@ -1,27 +1,137 @@
-from io import BytesIO
-from typing import Dict
+import asyncio
+from collections import deque
+from time import perf_counter
+from typing import Deque, Dict, Optional
 
 from discord import VoiceClient, AudioSource
-from izunadsp import DSPServer
 
+from core.music.dsp import DSPPool, POOL
 from core.music.queues import Queue
+from core.music.sources import BufferedSource, DSPSource, MartAudio
 
 
 class Player:
-    def __init__(self, voice_client: VoiceClient, queue: Queue, config: Dict = None):
+    """
+    Plays songs from `queue` until it has been empty for `idle_timeout`
+    seconds, then disconnects.
+
+    All queue access happens on the event loop in `run`; discord.py's
+    player thread only hands control back through call_soon_threadsafe.
+    The queue is closed as soon as `run` stops taking songs from it, so
+    `play` raises QueueClosed from then on instead of losing the song.
+    """
+    def __init__(self, voice_client: VoiceClient, queue: Queue, config: Dict = None,
+                 lead_frames: int = 250, idle_timeout: float = 300, pool: DSPPool = POOL):
         self.queue = queue
         self.voice_client = voice_client
         self.dsp_config = config
-        self.server = DSPServer()
-        for part, settings in config.items():
-            for attribute, value in settings.items():
-                self.server.config(part, attribute, value)
-
-    def play(self, song: AudioSource, **kwargs):
-        self.queue.add(song, **kwargs)
-
-    def play_next(self):
-        if self.queue:
-            self.voice_client.play(self.queue.get(), after=self.play_next)
-        else:
-            self.voice_client.disconnect()
+        self.pool = pool
+        # Shared with every player using the same config; only started once
+        # something actually needs DSP
+        self.server = pool.acquire(config)
+        self._manager = None
+
+        # The current track is buffered `lead_frames` ahead, so its source
+        # runs out that long before playback ends, which is when we start
+        # decoding the next one
+        self.lead_frames = lead_frames
+        self.idle_timeout = idle_timeout
+        self.current: Optional[BufferedSource] = None
+        self.prefetched: Optional[BufferedSource] = None
+        self.ended_at: Optional[float] = None
+        # Seconds between the end of a track and the first frame of the next
+        self.gaps: Deque[float] = deque(maxlen=100)
+        # Slowest recent DSP frame of each track, and how many frames of
+        # all tracks took longer than a frame's duration
+        self.dsp_latency: Deque[float] = deque(maxlen=100)
+        self.dsp_over_budget = 0
+
+        self.loop = asyncio.get_event_loop()
+        self.finished = asyncio.Event()
+        self.task = self.loop.create_task(self.run())
+
+    @property
+    def manager(self):
+        # One manager for the player's lifetime, so DSP state carries over
+        if self._manager is None:
+            self._manager = self.server.get_manager()
+        return self._manager
+
+    def dsp(self, source: AudioSource) -> DSPSource:
+        return DSPSource(source, self.manager)
+
+    @property
+    def closed(self) -> bool:
+        return self.queue.closed
+
+    async def play(self, song: AudioSource, **kwargs):
+        await self.queue.add(song, **kwargs)
+
+    def _buffered(self, source: MartAudio) -> BufferedSource:
+        buffered = getattr(source, "prefetch", None)
+        if buffered is None:
+            buffered = source.prefetch = BufferedSource(source, self.lead_frames, self._near_end)
+        return buffered
+
+    def _near_end(self):
+        # Called from the buffering thread
+        self.loop.call_soon_threadsafe(self.prefetch)
+
+    def prefetch(self):
+        """ Start decoding the head of the queue ahead of time """
+        head = self.queue.peek()
+        if self.prefetched is not None and self.prefetched.source is not head:
+            # The queue changed since; pause the stale prefetch but leave it
+            # attached to its source in case that still gets played later
+            self.prefetched.stop()
+            self.prefetched = None
+        if head is None or self.prefetched is not None:
+            return
+
+        self.prefetched = self._buffered(head)
+        self.prefetched.start()
+
+    def _after(self, error: Exception = None):
+        # Called from discord.py's player thread
+        self.loop.call_soon_threadsafe(self.finished.set)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        return {
+            "max_gap": max(self.gaps, default=0.0),
+            "max_dsp_latency": max(self.dsp_latency, default=0.0),
+            "dsp_over_budget": self.dsp_over_budget,
+        }
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    source = await self.queue.get(timeout=self.idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+
+                self.current = self._buffered(source)
+                if self.prefetched is not None and self.prefetched is not self.current:
+                    self.prefetched.stop()
+                self.prefetched = None
+
+                # Only go through DSP when there's something configured
+                playing = self.dsp(self.current) if self.dsp_config else self.current
+                self.finished.clear()
+                self.voice_client.play(playing, after=self._after)
+                await self.finished.wait()
+
+                if isinstance(playing, DSPSource):
+                    self.dsp_latency.append(playing.max_latency)
+                    self.dsp_over_budget += playing.overruns
+
+                if self.ended_at is not None and self.current.first_frame_at is not None:
+                    self.gaps.append(self.current.first_frame_at - self.ended_at)
+                # Waiting on an empty queue isn't a gap between tracks
+                self.ended_at = perf_counter() if self.queue else None
+        finally:
+            self.queue.close()
+            self.current = None
+            self.pool.release(self.server)
+            await self.voice_client.disconnect()
@@ -1,23 +1,81 @@
-from heapq import heappush, heappop
+import asyncio
+from collections import defaultdict, deque
+from heapq import heapify, heappush, heappop
 from random import shuffle
-from typing import List, Tuple
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from core.music.sources import MartAudio
 
 
+class QueueClosed(Exception):
+    """ Raised when adding to a queue whose player has stopped """
+
+
 class Queue:
-    """ FIFO Queue """
+    """
+    FIFO Queue
+
+    The public add/extend/shuffle/get coroutines hold `cond`, so they never
+    interleave, and get can wait for songs to arrive. Subclasses implement
+    the synchronous _add/_get/_shuffle. Queues belong to the event loop;
+    other threads have to go through loop.call_soon_threadsafe.
+
+    Once `close` has been called, adding raises QueueClosed.
+    """
     def __init__(self):
-        self.queue: List[MartAudio] = []
+        self.queue: Deque[MartAudio] = deque()
+        self.cond = asyncio.Condition()
+        self.closed = False
 
     def __bool__(self) -> bool:
-        return self.queue != []
-
-    def add(self, source: MartAudio, **kwargs):
+        return bool(self.queue)
+
+    async def add(self, source: MartAudio, **kwargs):
+        async with self.cond:
+            self._check_closed()
+            self._add(source, **kwargs)
+            self.cond.notify_all()
+
+    async def extend(self, sources: Iterable[MartAudio], **kwargs):
+        """ Add many songs at once, e.g. when importing a playlist """
+        async with self.cond:
+            self._check_closed()
+            self._extend(sources, **kwargs)
+            self.cond.notify_all()
+
+    def close(self):
+        # Synchronous, so nothing can be added between the consumer giving
+        # up and the queue being closed
+        self.closed = True
+
+    def _check_closed(self):
+        if self.closed:
+            raise QueueClosed("This queue is closed.")
+
+    async def get(self, timeout: float = None) -> MartAudio:
+        """ Wait up to `timeout` seconds for a song, raising asyncio.TimeoutError otherwise """
+        async with self.cond:
+            await asyncio.wait_for(self.cond.wait_for(self.__bool__), timeout)
+            return self._get()
+
+    def get_nowait(self) -> MartAudio:
+        return self._get()
+
+    async def shuffle(self):
+        async with self.cond:
+            self._shuffle()
+
+    def _add(self, source: MartAudio, **kwargs):
         self.queue.append(source)
 
-    def get(self) -> MartAudio:
-        return self.queue.pop(0)
+    def _extend(self, sources: Iterable[MartAudio], **kwargs):
+        self.queue.extend(sources)
+
+    def _get(self) -> MartAudio:
+        return self.queue.popleft()
+
+    def peek(self) -> Optional[MartAudio]:
+        return self.queue[0] if self.queue else None
 
     def clear(self):
         self.queue.clear()
@@ -26,8 +84,22 @@ class Queue:
         for song in self.queue:
             song.cleanup()
 
-    def shuffle(self):
-        shuffle(self.queue)
+    def _shuffle(self):
+        # shuffling a deque in place is quadratic
+        songs = list(self.queue)
+        shuffle(songs)
+        self.queue = deque(songs)
+
+
+class Chunk:
+    """ A run of up to `size` songs by the same requester, linked into a ChunkedQueue """
+    __slots__ = ("owner", "entries", "prev", "next")
+
+    def __init__(self, owner: int, entry: Tuple[int, MartAudio]):
+        self.owner = owner
+        self.entries: List[Tuple[int, MartAudio]] = [entry]
+        self.prev: Optional[Chunk] = None
+        self.next: Optional[Chunk] = None
 
 
 class ChunkedQueue(Queue):
@@ -40,24 +112,79 @@ class ChunkedQueue(Queue):
         self.size = chunk_size
         self.max = max_chunks
         self.user_max = max_per_user
-        self.items: List[List[Tuple[int, MartAudio]]] = []
+
+        # Waiting chunks as a doubly linked list, plus per-user indexes
+        self.head: Optional[Chunk] = None
+        self.tail: Optional[Chunk] = None
+        self.chunks = 0
+        self.last: Dict[int, Chunk] = {}
+        self.full: Dict[int, int] = defaultdict(int)
         super().__init__()
-        self.queue: List[Tuple[int, MartAudio]]
+        self.queue: Deque[Tuple[int, MartAudio]]
 
     def __bool__(self) -> bool:
-        return self._queue != []
+        return bool(self.queue) or self.head is not None
 
     def _error(self, err):
         raise Exception(err)
 
-    @property
-    def _queue(self):
-        r = self.queue[:]
-        for group in self.items:
-            r += group
-        return r
-
-    async def add(self, source: MartAudio, requester_id: int = None, **kwargs):
+    def _entries(self) -> Iterator[Tuple[int, MartAudio]]:
+        yield from self.queue
+        chunk = self.head
+        while chunk is not None:
+            yield from chunk.entries
+            chunk = chunk.next
+
+    def _link(self, chunk: Chunk, before: Optional[Chunk]):
+        # Insert `chunk` before `before`, or at the end if that is None
+        chunk.next = before
+        chunk.prev = self.tail if before is None else before.prev
+        if chunk.prev is None:
+            self.head = chunk
+        else:
+            chunk.prev.next = chunk
+        if before is None:
+            self.tail = chunk
+        else:
+            before.prev = chunk
+
+        self.chunks += 1
+        if len(chunk.entries) == self.size:
+            self.full[chunk.owner] += 1
+        # add() always inserts after the owner's previous last chunk
+        self.last[chunk.owner] = chunk
+
+    def _pop_head(self) -> Chunk:
+        chunk = self.head
+        self.head = chunk.next
+        if self.head is None:
+            self.tail = None
+        else:
+            self.head.prev = None
+        chunk.next = None
+
+        self.chunks -= 1
+        if len(chunk.entries) == self.size:
+            self.full[chunk.owner] -= 1
+        if self.last.get(chunk.owner) is chunk:
+            del self.last[chunk.owner]
+        return chunk
+
+    def _add(self, source: MartAudio, requester_id: int = None, **kwargs):
+        if self.head is not None:
+            if self.chunks == self.max:
+                self._error("Max queue chunks reached.")
+
+            if self.full[requester_id] == self.user_max:
+                self._error("User reached maximum amount of chunks")
+
+        self._insert((requester_id, source))
+
+    def _extend(self, sources: Iterable[MartAudio], requester_id: int = None, **kwargs):
+        for source in sources:
+            self._add(source, requester_id)
+
+    def _insert(self, entry: Tuple[int, MartAudio]):
         # === LOGIC ===
         # Basically, the first thing is to find the index of the user's
         # last song (since when they add something new, it should always be
@@ -79,113 +206,224 @@ class ChunkedQueue(Queue):
         # B is already in the set, so the A gets added here
         # ABCABCABCABBBBB
 
-        entry = (requester_id, source)
+        # The user's last chunk is looked up directly instead of searched
+        # for, and since the forward scan stops at the first repeated user
+        # it never visits more chunks than there are users in the queue.
+
+        requester_id = entry[0]
+        if self.head is None:
+            self._link(Chunk(requester_id, entry), None)
+            return
 
-        if not self.items:
-            self.items.append([entry])
+        start = self.last.get(requester_id)
+        if start is not None and len(start.entries) < self.size:
+            # last source by us has a free space left
+            start.entries.append(entry)
+            if len(start.entries) == self.size:
+                self.full[requester_id] += 1
             return
 
-        if len(self.items) == self.max:
-            self._error("Max queue chunks reached.")
-
-        x = 0
-        for chunk in self.items:
-            if chunk[0][0] == requester_id and len(chunk) == self.size:
-                x += 1
-
-        if x == self.user_max:
-            self._error("User reached maximum amount of chunks")
-
-        # Insert the data
-        # print("Iterating backwards")
-        for index, value in enumerate(reversed(self.items)):
-            # print(index)
-            if index == len(self.items) - 1 or value[0][0] == requester_id:
-                # we found the last source by us or
-                # we have no items in the queue
-
-                if value[0][0] == requester_id and len(value) < self.size:
-                    # last source by us has a free space left
-                    value.append(entry)
-                    return
-
-                # index to start from
-                # python is 0-indexed so subtract 1
-                start = len(self.items) - index - 1
-                found_ids = []
-
-                # Easier than `enumerate` in this case
-                # print("Iterating forward")
-                while True:
-                    # print(start)
-                    if start >= len(self.items):
-                        # print("Inserting at the end")
-                        # No place left, put it at the end
-                        self.items.append([entry])
-                        return
-
-                    requester_id = self.items[start][0][0]
-
-                    if requester_id in found_ids:
-                        # print("Duplicate found, inserting")
-                        # this id appears for the second time now
-                        # so insert here
-                        self.items.insert(start, [entry])
-                        return
-
-                    # Add the id to the list
-                    found_ids.append(requester_id)
-
-                    start += 1
-
-    def shuffle(self):
-        old = self.queue[:]
-        self.clear()
+        if start is None:
+            # nothing by us in the queue, start from the front
+            start = self.head
+
+        found_ids = set()
+        node = start
+        while node is not None and node.owner not in found_ids:
+            found_ids.add(node.owner)
+            node = node.next
+
+        # Either a duplicate was found, so insert before it, or there's no
+        # place left and it goes at the end
+        self._link(Chunk(requester_id, entry), node)
+
+    def _shuffle(self):
+        # Put every waiting song back in random order; going through the
+        # normal insertion keeps the chunk fairness intact
+        old = list(self._entries())
+        self._reset()
         shuffle(old)
-        for (requester, source) in old:
-            self.add(source, requester_id=requester)
+        for entry in old:
+            self._insert(entry)
 
-    def get(self) -> MartAudio:
-        if not self._queue:
+    def _get(self) -> MartAudio:
+        if not self.queue:
             # Load the next chunk
-            # we use `pop` to make sure it disappears from the original list
+            # we unlink it to make sure it disappears from the queue
             # because otherwise people could queue up forever
-            self.queue = self.items.pop(0)
-        return self._queue.pop(0)[1]
+            self.queue = deque(self._pop_head().entries)
+        return self.queue.popleft()[1]
 
-    def clear(self):
-        for i in self._queue:
-            i.cleanup()
-        self.items.clear()
+    def peek(self) -> Optional[MartAudio]:
+        if self.queue:
+            return self.queue[0][1]
+        return self.head.entries[0][1] if self.head is not None else None
+
+    def _reset(self):
         self.queue.clear()
+        self.head = self.tail = None
+        self.chunks = 0
+        self.last.clear()
+        self.full.clear()
+
+    def clear(self):
+        for _, source in self._entries():
+            source.cleanup()
+        self._reset()
 
     def cleanup(self):
-        for i in self._queue:
-            i.cleanup()
+        for _, source in self._entries():
+            source.cleanup()
 
 
 class PriorityQueue(Queue):
     def __init__(self):
         super().__init__()
+        self.queue: List[Tuple[int, int, MartAudio]] = []
         self._index = 0
 
-    def add(self, source: MartAudio, priority: int = 0, **kwargs):
+    def _add(self, source: MartAudio, priority: int = 0, **kwargs):
         heappush(self.queue, (-priority, self._index, source))
         self._index += 1
 
-    def get(self) -> MartAudio:
-        return heappop(self.queue)
+    def _extend(self, sources: Iterable[MartAudio], priority: int = 0, **kwargs):
+        start = self._index
+        entries = [(-priority, start + i, source) for i, source in enumerate(sources)]
+        self._index += len(entries)
+        if len(entries) * 4 < len(self.queue):
+            # a few pushes are cheaper than rebuilding a large heap
+            for entry in entries:
+                heappush(self.queue, entry)
+        else:
+            self.queue.extend(entries)
+            heapify(self.queue)
 
-    def shuffle(self):
-        old = self.queue[:]
-        self.queue = []
-        shuffle(old)
-        for priority, _, source in old:
-            self.add(source, -priority)
+    def _get(self) -> MartAudio:
+        return heappop(self.queue)[2]
+
+    def peek(self) -> Optional[MartAudio]:
+        return self.queue[0][2] if self.queue else None
+
+    def cleanup(self):
+        for _, _, song in self.queue:
+            song.cleanup()
+
+    def _shuffle(self):
+        # New tie-breaking indices in random order shuffle songs of the same
+        # priority, then one O(n) heapify restores the heap
+        shuffle(self.queue)
+        for i, (priority, _, source) in enumerate(self.queue):
+            self.queue[i] = (priority, self._index + i, source)
+        self._index += len(self.queue)
+        heapify(self.queue)
 
 
 class ChunkedPriorityQueue(Queue):
-    pass
+    """
+    Priority within each user's songs, chunks round-robin between users
+
+    Every user has their own priority heap and a round number. Each get
+    serves the next chunk from the user with the lowest round, ties going
+    to the user with the highest priority song, and then moves that user
+    to the next round. Users who (re)join start in the current round, so
+    idle time doesn't build up credit. `add` and `get` are O(log n).
+    """
+
+    def __init__(self,
+                 chunk_size=2,
+                 max_per_user=-1):
+        self.size = chunk_size
+        self.user_max = max_per_user
+        self.heaps: Dict[int, List[Tuple[int, int, MartAudio]]] = {}
+        self.rounds: Dict[int, int] = {}
+        self.round = 0
+        # (round, -priority, index, requester) of each user's head song;
+        # outdated entries are skipped when they reach the top
+        self.ready: List[Tuple[int, int, int, int]] = []
+        self._index = 0
+        super().__init__()
+
+    def __bool__(self) -> bool:
+        return bool(self.queue) or bool(self.heaps)
+
+    def _schedule(self, requester: int):
+        priority, index, _ = self.heaps[requester][0]
+        heappush(self.ready, (self.rounds[requester], priority, index, requester))
+
+    def _top(self) -> Optional[int]:
+        while self.ready:
+            round_, priority, index, requester = self.ready[0]
+            heap = self.heaps.get(requester)
+            if heap and self.rounds[requester] == round_ and heap[0][:2] == (priority, index):
+                return requester
+            heappop(self.ready)
+        return None
+
+    def _add(self, source: MartAudio, requester_id: int = None, priority: int = 0, **kwargs):
+        heap = self.heaps.get(requester_id)
+        if heap is not None and len(heap) // self.size == self.user_max:
+            raise Exception("User reached maximum amount of chunks")
+
+        entry = (-priority, self._index, source)
+        self._index += 1
+        if heap is None:
+            self.heaps[requester_id] = [entry]
+            self.rounds[requester_id] = max(self.rounds.get(requester_id, 0), self.round)
+            self._schedule(requester_id)
+        else:
+            heappush(heap, entry)
+            if heap[0] is entry:
+                self._schedule(requester_id)
+
+    def _extend(self, sources: Iterable[MartAudio], requester_id: int = None, priority: int = 0, **kwargs):
+        for source in sources:
+            self._add(source, requester_id, priority)
+
+    def _get(self) -> MartAudio:
+        if not self.queue:
+            requester = self._top()
+            heappop(self.ready)
+            heap = self.heaps[requester]
+            self.queue = deque(heappop(heap)[2] for _ in range(min(self.size, len(heap))))
+            self.round = self.rounds[requester]
+            self.rounds[requester] += 1
+            if heap:
+                self._schedule(requester)
+            else:
+                del self.heaps[requester]
+        return self.queue.popleft()
+
+    def peek(self) -> Optional[MartAudio]:
+        if self.queue:
+            return self.queue[0]
+        requester = self._top()
+        return self.heaps[requester][0][2] if requester is not None else None
+
+    def clear(self):
+        self.cleanup()
+        self.queue.clear()
+        self.heaps.clear()
+        self.ready.clear()
+
+    def cleanup(self):
+        for song in self.queue:
+            song.cleanup()
+        for heap in self.heaps.values():
+            for _, _, song in heap:
+                song.cleanup()
+
+    def _shuffle(self):
+        # Shuffles songs of equal priority, per user
+        for heap in self.heaps.values():
+            shuffle(heap)
+            for i, (priority, _, source) in enumerate(heap):
+                heap[i] = (priority, self._index + i, source)
+            self._index += len(heap)
+            heapify(heap)
+
+        self.ready = []
+        for requester in self.heaps:
+            self._schedule(requester)
 
 
 class QUEUE:
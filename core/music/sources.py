@@ -1,39 +1,157 @@
-import audioop
+import mmap
+import threading
+from collections import deque
 from io import BytesIO
-from typing import Type
+from time import perf_counter
+from typing import Callable, Deque, List, Optional, Type
 
+import numpy as np
 from discord import PCMAudio, FFmpegPCMAudio, AudioSource
-from izunadsp import DSPServer
+from discord.opus import Encoder
 from mart_music.common import Song
 
 
 class MartAudio(AudioSource):
-    def __init__(self, origin: Song):
+    """
+    A song backed by a file on disk.
+
+    Only the path is kept while the song waits in a queue; the file is
+    opened on the first `read` and closed again by `cleanup`, which also
+    calls `release` to hand the file back to whoever stores it.
+    """
+    def __init__(self, path: str, origin: Song, release: Callable[[], None] = None):
+        self.path = path
         self.origin = origin
+        self.release = release
+        self.closed = False
 
     def to(self, cls: Type[AudioSource], **kwargs):
-        return cls(self.source, **kwargs)
+        # The new source takes over the file
+        release, self.release = self.release, None
+        return cls(self.path, self.origin, release, **kwargs)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.release is not None:
+                self.release()
 
 
 class MartPCMAudio(PCMAudio, MartAudio):
-    def __init__(self, source: BytesIO, origin: Song):
-        MartAudio.__init__(self, origin)
-        PCMAudio.__init__(self, source)
+    def __init__(self, path: str, origin: Song, release: Callable[[], None] = None):
+        MartAudio.__init__(self, path, origin, release)
+        self.stream = None
+        self.file = None
+
+    def _open(self):
+        self.file = open(self.path, "rb")
+        try:
+            self.stream = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            self.stream = self.file
+
+    def read(self):
+        if self.closed:
+            return b''
+        if self.file is None:
+            self._open()
+        return PCMAudio.read(self)
+
+    def cleanup(self):
+        if self.stream is not None and self.stream is not self.file:
+            self.stream.close()
+        if self.file is not None:
+            self.file.close()
+        self.stream = None
+        self.file = None
+        self.close()
 
 
 class MartFFmpegPCMAudio(FFmpegPCMAudio, MartAudio):
-    def __init__(self, source: BytesIO, origin: Song):
-        MartAudio.__init__(self, origin)
-        FFmpegPCMAudio.__init__(self, source)
+    def __init__(self, path: str, origin: Song, release: Callable[[], None] = None, **options):
+        MartAudio.__init__(self, path, origin, release)
+        self.options = options
+        self._process = None
+        self._started = False
+
+    def read(self):
+        if self.closed:
+            return b''
+        if not self._started:
+            # FFmpeg reads the file itself, so it only starts once playing
+            self._started = True
+            FFmpegPCMAudio.__init__(self, self.path, **self.options)
+        return FFmpegPCMAudio.read(self)
+
+    def cleanup(self):
+        FFmpegPCMAudio.cleanup(self)
+        self.close()
+
+
+class Mixer:
+    """ Mixes int16 PCM frames using preallocated buffers """
+    LINEAR = "linear"
+    EQUAL_POWER = "equal_power"
+
+    def __init__(self, fade_frames: int, curve: str = LINEAR,
+                 frame_size: int = Encoder.FRAME_SIZE, channels: int = Encoder.CHANNELS):
+        samples = frame_size // 2
+        self.curve = curve
+        self.frame_samples = samples // channels
+        self.fade_samples = fade_frames * self.frame_samples
+        # Position of every interleaved sample within the frame, per channel
+        self.offsets = np.repeat(np.arange(samples // channels, dtype=np.float32), channels)
+
+        self.acc = np.empty(samples, dtype=np.float32)
+        self.tmp = np.empty(samples, dtype=np.float32)
+        self.gain_in = np.empty(samples, dtype=np.float32)
+        self.gain_out = np.empty(samples, dtype=np.float32)
+        self.out = np.empty(samples, dtype=np.int16)
+
+    def _gains(self, pos: int, n: int):
+        t = self.gain_in[:n]
+        np.add(self.offsets[:n], pos * self.frame_samples, out=t)
+        t *= 1 / max(self.fade_samples, 1)
+        np.clip(t, 0, 1, out=t)
+
+        if self.curve == self.EQUAL_POWER:
+            t *= np.pi / 2
+            np.cos(t, out=self.gain_out[:n])
+            np.sin(t, out=t)
+        else:
+            np.subtract(1, t, out=self.gain_out[:n])
+
+    def mix(self, current: bytes, overlay: bytes, pos: int = None) -> bytes:
+        """ Adds two frames, fading from `current` to `overlay` if `pos` is given """
+        n = min(len(current), len(overlay)) // 2
+        cur = np.frombuffer(current, dtype=np.int16, count=n)
+        ovl = np.frombuffer(overlay, dtype=np.int16, count=n)
+        acc = self.acc[:n]
+
+        if pos is None:
+            np.add(cur, ovl, out=acc, dtype=np.float32)
+        else:
+            self._gains(pos, n)
+            np.multiply(cur, self.gain_out[:n], out=acc)
+            np.multiply(ovl, self.gain_in[:n], out=self.tmp[:n])
+            acc += self.tmp[:n]
+            np.rint(acc, out=acc)
+
+        # Saturate instead of wrapping around
+        np.clip(acc, -32768, 32767, out=acc)
+        out = self.out[:n]
+        np.copyto(out, acc, casting="unsafe")
+        return out.tobytes()
 
 
 class CrossfadeSource(AudioSource):
-    def __init__(self, source: AudioSource, steps: int = 10, fade: bool = True):
+    def __init__(self, source: AudioSource, steps: int = 10, fade: bool = True, curve: str = Mixer.LINEAR):
         self.current_source = source
         self.overlay_source = None
 
         self.fade = fade
-        self.step = 1/(2 * steps)
+        self.mixer = Mixer(2 * steps, curve)
         self._pos = 0
 
     def read(self):
@@ -53,29 +171,279 @@ class CrossfadeSource(AudioSource):
             return current
 
         if self.fade:
-            vol = self.step * self._pos
-            sub = 1 - vol
             self._pos += 1
+            return self.mixer.mix(current, overlay, self._pos - 1)
+
+        return self.mixer.mix(current, overlay)
+
+    def is_opus(self):
+        return False
+
+
+class Track:
+    """ A child source of a MixerSource with its own gain envelope """
+    def __init__(self, source: AudioSource, gain: float = 1.0):
+        self.source = source
+        self.gain = gain
+        self.target = gain
+        self.step = 0.0
+
+    def fade_to(self, gain: float, frames: int = 1):
+        """ Ramp linearly to `gain` over `frames` 20 ms frames """
+        self.target = gain
+        self.step = (gain - self.gain) / max(frames, 1)
+
+    def advance(self) -> float:
+        """ Returns the gain at the end of the current frame """
+        if self.gain != self.target:
+            self.gain += self.step
+            if (self.step > 0) == (self.gain >= self.target):
+                self.gain = self.target
+        return self.gain
+
+
+class MixerSource(AudioSource):
+    """
+    Sums any number of PCM tracks into one stream, dropping tracks once they end
+
+    `add` and `remove` only hold `lock` briefly, so they can be called from
+    the event loop while `read` waits on a slow track. A track removed
+    during a read is cleaned up by that read once it's done with it.
+    """
+    def __init__(self, *sources: AudioSource, keep_alive: bool = False,
+                 frame_size: int = Encoder.FRAME_SIZE, channels: int = Encoder.CHANNELS):
+        self.tracks: List[Track] = []
+        self.keep_alive = keep_alive
+        self.lock = threading.RLock()
+        self.reading = False
+        self.retired: List[Track] = []
 
-            current = audioop.mul(current, 2, sub)
-            overlay = audioop.mul(overlay, 2, vol)
+        self.samples = frame_size // 2
+        # 0 -> 1 across the frame, per channel, for interpolating gains
+        per_channel = self.samples // channels
+        self.ramp = np.repeat(np.arange(1, per_channel + 1, dtype=np.float32) / per_channel, channels)
+        self.frames = np.empty((0, self.samples), dtype=np.float32)
+        self.gains = np.empty((0, self.samples), dtype=np.float32)
+        self.acc = np.empty(self.samples, dtype=np.float32)
+        self.out = np.empty(self.samples, dtype=np.int16)
+        self.silence = bytes(frame_size)
 
-        return audioop.add(current, overlay, 2)
+        for source in sources:
+            self.add(source)
+
+    def add(self, source: AudioSource, gain: float = 1.0) -> Track:
+        track = Track(source, gain)
+        with self.lock:
+            self.tracks.append(track)
+            if len(self.tracks) > len(self.frames):
+                # Grow the work buffers; they are reused for every frame after.
+                # New arrays, so a read in progress keeps using its own
+                self.frames = np.zeros((len(self.tracks), self.samples), dtype=np.float32)
+                self.gains = np.zeros((len(self.tracks), self.samples), dtype=np.float32)
+        return track
+
+    def remove(self, track: Track):
+        with self.lock:
+            if track not in self.tracks:
+                return
+            self.tracks.remove(track)
+            if self.reading:
+                self.retired.append(track)
+                return
+        track.source.cleanup()
+
+    def read(self):
+        with self.lock:
+            tracks, frames, gains = self.tracks[:], self.frames, self.gains
+            self.reading = True
+
+        ended = []
+        try:
+            return self._read(tracks, frames, gains, ended)
+        finally:
+            with self.lock:
+                self.reading = False
+                for track in ended:
+                    if track in self.tracks:
+                        self.tracks.remove(track)
+                        self.retired.append(track)
+                retired, self.retired = self.retired, []
+            for track in retired:
+                track.source.cleanup()
+
+    def _read(self, tracks: List[Track], frames: np.ndarray, gains: np.ndarray, ended: List[Track]) -> bytes:
+        # Only touches the lock-free snapshot and the output buffers, which
+        # nothing but the reading thread uses
+        active = 0
+        for track in tracks:
+            data = track.source.read()
+            if not data:
+                ended.append(track)
+                continue
+
+            i = active
+            n = len(data) // 2
+            frames[i, :n] = np.frombuffer(data, dtype=np.int16, count=n)
+            frames[i, n:] = 0
+            start = track.gain
+            end = track.advance()
+            np.multiply(self.ramp, end - start, out=gains[i])
+            gains[i] += start
+            active += 1
+
+        if not active:
+            return self.silence if self.keep_alive else b''
+
+        np.einsum("ij,ij->j", frames[:active], gains[:active], out=self.acc)
+        np.rint(self.acc, out=self.acc)
+        np.clip(self.acc, -32768, 32767, out=self.acc)
+        np.copyto(self.out, self.acc, casting="unsafe")
+        return self.out.tobytes()
+
+    def cleanup(self):
+        with self.lock:
+            tracks, self.tracks = self.tracks, []
+        for track in tracks:
+            track.source.cleanup()
 
     def is_opus(self):
         return False
 
 
-class DSPSource(AudioSource):
-    def __init__(self, source: AudioSource, server: DSPServer):
+class BufferedSource(AudioSource):
+    """
+    Reads frames from `source` ahead of time on a background thread.
+
+    Up to `depth` frames are kept in a ring buffer that `read` pops from,
+    so a stall in the wrapped source only becomes audible once the buffer
+    runs dry. Every time `read` has to wait on an empty buffer counts as
+    an underrun.
+
+    `on_end` is called from the background thread once `source` runs out,
+    which is `depth` frames before playback reaches the end. An error in
+    `source` ends the stream the same way and is kept in `error`; so does
+    a `read` that has waited `timeout` seconds for a frame.
+    """
+    def __init__(self, source: AudioSource, depth: int = 50, on_end: Callable[[], None] = None,
+                 timeout: float = 5.0):
         self.source = source
-        self.server = server
+        self.depth = depth
+        self.on_end = on_end
+        self.timeout = timeout
+        self.underruns = 0
+        self.error: Optional[Exception] = None
+        self.first_frame_at: Optional[float] = None
+
+        self.buffer: Deque[Optional[bytes]] = deque()
+        self.cond = threading.Condition()
+        self._stopped = False
+        self._ended = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """ Start or resume prefetching; called on the first `read` otherwise """
+        with self.cond:
+            self._stopped = False
+            if not self._ended and (self._thread is None or not self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """ Pause prefetching, keeping what has been buffered so far """
+        with self.cond:
+            self._stopped = True
+            self.cond.notify_all()
+
+    def set_depth(self, depth: int):
+        with self.cond:
+            self.depth = depth
+            self.cond.notify_all()
+
+    def process(self, frame: bytes) -> bytes:
+        return frame
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self._stopped or len(self.buffer) < self.depth)
+                if self._stopped:
+                    return
+
+            try:
+                frame = self.source.read()
+                out = self.process(frame) if frame else None
+            except Exception as e:
+                self.error = e
+                out = None
+
+            with self.cond:
+                self.buffer.append(out)
+                self._ended = out is None
+                self.cond.notify_all()
+            if out is None:
+                if self.on_end is not None:
+                    self.on_end()
+                return
 
     def read(self):
-        file = BytesIO(self.source.read())
-        manager = self.server.get_manager()
-        res_file = manager.passthrough(file, suffix=".opus")
-        return res_file.read()
+        self.start()
+        with self.cond:
+            if not self.buffer:
+                self.underruns += 1
+                self.cond.wait_for(lambda: self.buffer or self._ended or self._stopped, self.timeout)
+                if not self.buffer:
+                    return b''
+            frame = self.buffer[0]
+            if frame is None:
+                return b''
+            self.buffer.popleft()
+            self.cond.notify_all()
+        if self.first_frame_at is None:
+            self.first_frame_at = perf_counter()
+        return frame
+
+    def cleanup(self):
+        self.stop()
+        self.source.cleanup()
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+
+class DSPSource(BufferedSource):
+    """
+    Runs frames through one long-lived DSP manager ahead of playback.
+
+    Reusing the manager keeps its filter state across frame boundaries.
+    izunadsp only has a file-based passthrough, so every frame is still
+    its own call; the buffer just keeps that work off the player thread.
+    """
+    def __init__(self, source: AudioSource, manager, depth: int = 5):
+        super().__init__(source, depth)
+        self.manager = manager
+        # Seconds spent processing each of the most recent frames
+        self.latency: Deque[float] = deque(maxlen=250)
+        # Frames that took longer than a frame's duration, over the whole stream
+        self.overruns = 0
+        self.start()
+
+    def process(self, frame: bytes) -> bytes:
+        start = perf_counter()
+        out = self.manager.passthrough(BytesIO(frame), suffix=".opus").read()
+        elapsed = perf_counter() - start
+        self.latency.append(elapsed)
+        if elapsed > Encoder.FRAME_LENGTH / 1000:
+            self.overruns += 1
+        return out
+
+    @property
+    def max_latency(self) -> float:
+        return max(self.latency, default=0.0)
+
+    @property
+    def over_budget(self) -> int:
+        """ Number of recent frames that took longer than a frame's duration """
+        return sum(t > Encoder.FRAME_LENGTH / 1000 for t in self.latency)
 
     def is_opus(self):
         return True
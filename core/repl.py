@@ -0,0 +1,357 @@
+import asyncio
+import ast
+import ctypes
+import inspect
+import sys
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar, copy_context
+from functools import lru_cache
+from io import TextIOBase
+from textwrap import dedent
+from traceback import format_exception
+from time import monotonic
+from types import CodeType, FunctionType
+from typing import Any, Callable, Dict, Iterable, List, Optional, TextIO
+
+FILENAME = "<eval-repl>"
+FUNC_NAME = "__repl__"
+
+# The snippet body replaces `pass`; `_` picks up the final expression
+TEMPLATE = """
+{prefix}def {name}():
+    pass
+""".strip()
+
+RESULT = """
+_ = None
+return _
+""".strip()
+
+# Where `print` goes for the current task or thread
+OUTPUT: ContextVar[Optional[TextIO]] = ContextVar("repl_output", default=None)
+
+
+class Interrupted(Exception):
+    """ Raised inside a snippet's thread once it is cancelled or times out """
+
+
+class SnippetTimeout(Exception):
+    """ The snippet ran past its time limit """
+
+
+class OutputCapture(TextIOBase):
+    """ Stands in for sys.stdout, writing to `OUTPUT` where it is set """
+    def __init__(self, fallback: TextIO):
+        self.fallback = fallback
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        return (OUTPUT.get() or self.fallback).write(text)
+
+    def flush(self):
+        (OUTPUT.get() or self.fallback).flush()
+
+
+def capture_stdout():
+    if not isinstance(sys.stdout, OutputCapture):
+        sys.stdout = OutputCapture(sys.stdout)
+
+
+def release_stdout():
+    if isinstance(sys.stdout, OutputCapture):
+        sys.stdout = sys.stdout.fallback
+
+
+def normalize(source: str) -> str:
+    # Anything more than this could change the meaning of string literals
+    return dedent(source).strip()
+
+
+def is_async(tree: ast.AST) -> bool:
+    return any(isinstance(node, (ast.Await, ast.AsyncFor, ast.AsyncWith))
+               or isinstance(node, ast.comprehension) and node.is_async
+               for node in ast.walk(tree))
+
+
+class BoundNames(ast.NodeVisitor):
+    """ Names a block of statements binds in its own scope, not in nested ones """
+    def __init__(self):
+        self.names = set()
+
+    def visit_Name(self, node: ast.Name):
+        if isinstance(node.ctx, (ast.Store, ast.Del)):
+            self.names.add(node.id)
+
+    def visit_alias(self, node: ast.alias):
+        if node.name != "*":
+            self.names.add((node.asname or node.name).split(".")[0])
+
+    def visit_ExceptHandler(self, node: ast.ExceptHandler):
+        if node.name is not None:
+            self.names.add(node.name)
+        self.generic_visit(node)
+
+    def visit_MatchAs(self, node: ast.AST):
+        # Also MatchStar, and MatchMapping's `**rest`
+        name = getattr(node, "name", None) or getattr(node, "rest", None)
+        if name is not None:
+            self.names.add(name)
+        self.generic_visit(node)
+
+    visit_MatchStar = visit_MatchMapping = visit_MatchAs
+
+    def visit_FunctionDef(self, node: ast.AST):
+        self.names.add(node.name)
+
+    visit_AsyncFunctionDef = visit_ClassDef = visit_FunctionDef
+
+    def visit_Lambda(self, node: ast.Lambda):
+        pass
+
+    def visit_ListComp(self, node: ast.AST):
+        # Comprehensions have their own scope, except for walrus targets
+        self.names.update(child.target.id for child in ast.walk(node) if isinstance(child, ast.NamedExpr))
+
+    visit_SetComp = visit_DictComp = visit_GeneratorExp = visit_ListComp
+
+    def visit_Global(self, node: ast.Global):
+        pass
+
+    visit_Nonlocal = visit_Global
+
+
+def bound_names(body: List[ast.stmt]) -> List[str]:
+    visitor = BoundNames()
+    for node in body:
+        visitor.visit(node)
+    return sorted(visitor.names)
+
+
+class AnnotationsToAssigns(ast.NodeTransformer):
+    """ Annotated names can't be declared global, so the annotations are dropped """
+    def visit_AnnAssign(self, node: ast.AnnAssign):
+        if not isinstance(node.target, ast.Name):
+            return node
+        if node.value is None:
+            return ast.copy_location(ast.Pass(), node)
+        return ast.copy_location(ast.Assign(targets=[node.target], value=node.value), node)
+
+    def visit_FunctionDef(self, node: ast.AST):
+        # Nested scopes can keep theirs
+        return node
+
+    visit_AsyncFunctionDef = visit_ClassDef = visit_FunctionDef
+
+
+def transform(tree: ast.Module) -> ast.Module:
+    """
+    Wraps a parsed snippet in a function that returns its final expression.
+
+    Every name the snippet binds is declared global, so it lives in the
+    session's namespace like it would at a REPL prompt. The function is
+    only async if the snippet awaits anything.
+    """
+    body = [AnnotationsToAssigns().visit(node) for node in tree.body]
+    if body and isinstance(body[-1], ast.Expr):
+        result = ast.parse(RESULT).body
+        result[0].value = body[-1].value
+        body = body[:-1] + result
+
+    names = bound_names(body)
+    if names:
+        body = [ast.Global(names=names)] + body
+
+    module = ast.parse(TEMPLATE.format(prefix="async " if is_async(tree) else "", name=FUNC_NAME))
+    module.body[0].body = body or [ast.Pass()]
+    return ast.fix_missing_locations(module)
+
+
+@lru_cache(maxsize=256)
+def _compile(source: str) -> CodeType:
+    module = compile(transform(ast.parse(source, FILENAME)), FILENAME, "exec")
+    return next(const for const in module.co_consts
+                if isinstance(const, CodeType) and const.co_name == FUNC_NAME)
+
+
+def compile_snippet(source: str, env: dict) -> FunctionType:
+    """
+    Returns a function running `source` with `env` as its globals.
+
+    Code objects are cached by normalized source, so repeated snippets are
+    only parsed and compiled once.
+    """
+    return FunctionType(_compile(normalize(source)), env)
+
+
+def _interrupt(thread: threading.Thread):
+    # Only takes effect once the thread runs Python code again
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread.ident), ctypes.py_object(Interrupted))
+
+
+def _resolve(future: asyncio.Future, result: Any = None, error: BaseException = None):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+async def run_in_thread(func: Callable[[], Any], timeout: float) -> Any:
+    """ Runs `func` on its own thread, interrupting it on timeout or cancellation """
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    # Carries OUTPUT over to the thread
+    context = copy_context()
+
+    def target():
+        try:
+            result = context.run(func)
+        except Interrupted:
+            return
+        except BaseException as e:
+            loop.call_soon_threadsafe(_resolve, future, None, e)
+        else:
+            loop.call_soon_threadsafe(_resolve, future, result)
+
+    thread = threading.Thread(target=target, name="eval-snippet", daemon=True)
+    thread.start()
+    return await _wait(future, timeout, lambda: _interrupt(thread))
+
+
+async def _wait(future: asyncio.Future, timeout: float, on_cancel: Callable[[], None] = None) -> Any:
+    # Unlike wait_for, this keeps a TimeoutError raised by the snippet
+    # itself apart from running out of time
+    def cancel():
+        future.cancel()
+        if on_cancel is not None:
+            on_cancel()
+
+    try:
+        done, _ = await asyncio.wait({future}, timeout=timeout)
+    except asyncio.CancelledError:
+        cancel()
+        raise
+    if not done:
+        cancel()
+        raise SnippetTimeout(f"Timed out after {timeout} seconds.")
+    return future.result()
+
+
+async def run_snippet(func: FunctionType, timeout: float) -> Any:
+    """
+    Runs a compiled snippet with a timeout.
+
+    Async snippets run on the event loop; anything else runs on a worker
+    thread so it can't block the loop. An awaitable result is awaited
+    on the loop either way.
+    """
+    if inspect.iscoroutinefunction(func):
+        result = await _wait(asyncio.ensure_future(func()), timeout)
+    else:
+        result = await run_in_thread(func, timeout)
+
+    if inspect.isawaitable(result):
+        result = await _wait(asyncio.ensure_future(result), timeout)
+    return result
+
+
+def format_error(error: BaseException) -> str:
+    """ Formats a traceback starting at the snippet's own frames """
+    tb = error.__traceback__
+    while tb is not None and tb.tb_frame.f_code.co_filename != FILENAME:
+        tb = tb.tb_next
+    return "".join(format_exception(type(error), error, tb))
+
+
+def sizeof(obj: Any, limit: int = 10000) -> int:
+    """ Approximate deep size of `obj` in bytes, looking at no more than `limit` objects """
+    seen = set()
+    stack = [obj]
+    size = 0
+    while stack and len(seen) < limit:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj, 0)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, "__dict__") and not inspect.ismodule(obj):
+            stack.append(vars(obj))
+    return size
+
+
+class Session:
+    """
+    Globals for one eval user in one channel.
+
+    Names from `base` are always available. Of the names snippets define
+    themselves, only the `max_names` most recently assigned are kept, and
+    older ones are dropped while they add up to more than `max_bytes` as
+    measured by `sizeof`. The most recent name is always kept, whatever
+    its size.
+
+    The invoking message's context is put straight into `env`, so runs
+    have to hold `lock` from `enter` until `exit`; otherwise a second run
+    would take `ctx` and friends away from one still going on its thread.
+    """
+    def __init__(self, base: Dict[str, Any], max_names: int = 50, max_bytes: int = 64 * 1024 * 1024):
+        self.base = base
+        self.env = dict(base)
+        self.max_names = max_names
+        self.max_bytes = max_bytes
+        # User-defined names, least recently assigned first, with the id of their value
+        self.names: "OrderedDict[str, int]" = OrderedDict()
+        self.last_used = monotonic()
+        self.runs = 0
+        self.lock = asyncio.Lock()
+
+    def enter(self, context: Dict[str, Any]):
+        """ Makes the invoking message's context available for one run """
+        self.last_used = monotonic()
+        self.runs += 1
+        self.env.update(context)
+
+    def exit(self, context: Iterable[str]):
+        # Don't keep the invoking message alive until the next run
+        for name in context:
+            self.env.pop(name, None)
+        self.trim()
+
+    def trim(self):
+        for name, value in list(self.env.items()):
+            if name in self.base or name.startswith("__"):
+                continue
+            if self.names.get(name) != id(value):
+                self.names[name] = id(value)
+                self.names.move_to_end(name)
+        for name in [name for name in self.names if name not in self.env]:
+            del self.names[name]
+
+        while len(self.names) > self.max_names:
+            name, _ = self.names.popitem(last=False)
+            self.env.pop(name, None)
+
+        # Objects shared between names are counted for each of them
+        sizes = {name: sizeof(self.env[name]) for name in self.names}
+        total = sum(sizes.values())
+        while len(self.names) > 1 and total > self.max_bytes:
+            name, _ = self.names.popitem(last=False)
+            self.env.pop(name, None)
+            total -= sizes[name]
+
+    def usage(self) -> Dict[str, int]:
+        user = {name: self.env[name] for name in self.names if name in self.env}
+        return {
+            "names": len(user),
+            "bytes": sizeof(user),
+            "runs": self.runs,
+            "idle": int(monotonic() - self.last_used),
+        }
@@ -0,0 +1,46 @@
+"""
+TieredCache's memory and disk tiers.
+
+    python -m pytest tests
+"""
+import asyncio
+import os
+
+from core.cache import TieredCache
+
+
+def test_async_round_trip(tmp_path):
+    async def main():
+        cache = TieredCache(str(tmp_path), max_memory=0, max_disk=2500)
+        keys = [TieredCache.key(str(i), width=512) for i in range(3)]
+        for i, key in enumerate(keys):
+            path = await cache.put_async(key, bytes([i]) * 1000, "ascii.png")
+            assert os.path.getsize(path) == 1000
+
+        # Over budget, so the least recently used one went
+        assert await cache.get_async(keys[0]) is None
+        assert await cache.get_async(keys[2]) == (bytes([2]) * 1000, "ascii.png")
+        assert await cache.put_async(TieredCache.key("big"), bytes(3000), "ascii.png") is None
+
+        os.remove(cache._path(keys[1], "ascii.png"))
+        assert await cache.get_async(keys[1]) is None
+        assert keys[1] not in cache.disk
+        return cache.stats
+
+    stats = asyncio.run(main())
+    assert (stats["disk_hits"], stats["misses"], stats["disk_bytes"]) == (1, 2, 1000)
+
+
+def test_memory_tier_and_rescan(tmp_path):
+    cache = TieredCache(str(tmp_path), max_memory=1500)
+    first, second = TieredCache.key("a"), TieredCache.key("b")
+    cache.put(first, b"a" * 1000, "ascii.webp")
+    cache.put(second, b"b" * 1000, "ascii.webp")
+    assert list(cache.memory) == [second]
+    assert asyncio.run(cache.get_async(second)) == (b"b" * 1000, "ascii.webp")
+    assert cache.stats["hits"] == 1
+
+    # A new cache finds what's on disk
+    again = TieredCache(str(tmp_path))
+    assert again.get(first) == (b"a" * 1000, "ascii.webp")
+    assert again.stats["disk_hits"] == 1
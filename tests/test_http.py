@@ -0,0 +1,105 @@
+"""
+Fetcher against a local aiohttp server.
+
+    python -m pytest tests
+"""
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from core.http import Fetcher, FetchError
+
+BODY = bytes(range(256)) * 1024
+
+
+def run(test, **fetcher_options):
+    """ Runs `test(fetcher, server, hits)` with a fresh server and fetcher """
+    hits = []
+
+    async def body(request: web.Request) -> web.StreamResponse:
+        hits.append(request.path)
+        # Let concurrent requests for the same URL pile up
+        await asyncio.sleep(0.05)
+        return web.Response(body=BODY)
+
+    async def streamed(request: web.Request) -> web.StreamResponse:
+        # No Content-Length, so only the streamed size can be checked
+        hits.append(request.path)
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        for _ in range(4):
+            await response.write(BODY)
+        await response.write_eof()
+        return response
+
+    async def missing(request: web.Request) -> web.StreamResponse:
+        raise web.HTTPNotFound()
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/body", body)
+        app.router.add_get("/streamed", streamed)
+        app.router.add_get("/missing", missing)
+        async with TestServer(app) as server:
+            fetcher = Fetcher(**fetcher_options)
+            try:
+                await test(fetcher, server, hits)
+            finally:
+                await fetcher.close()
+
+    asyncio.run(main())
+
+
+def test_fetch_spools_body():
+    async def test(fetcher, server, hits):
+        with await fetcher.fetch(str(server.make_url("/body"))) as fetched:
+            assert fetched.read() == BODY
+            assert fetched.size == len(BODY)
+            assert fetched.buffer._rolled
+        assert fetched.buffer.closed
+
+    run(test, spool_size=1024)
+
+
+def test_concurrent_fetches_share_one_download():
+    async def test(fetcher, server, hits):
+        url = str(server.make_url("/body"))
+
+        async def use():
+            # Like AsciiCog.ascii, done with it before the others resume
+            with await fetcher.fetch(url) as fetched:
+                return fetched.read()
+
+        assert await asyncio.gather(*(use() for _ in range(5))) == [BODY] * 5
+        assert hits == ["/body"]
+
+    run(test)
+
+
+def test_cancelled_waiter_leaves_others_alone():
+    async def test(fetcher, server, hits):
+        url = str(server.make_url("/body"))
+        cancelled = asyncio.ensure_future(fetcher.fetch(url))
+        other = asyncio.ensure_future(fetcher.fetch(url))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+
+        with await other as fetched:
+            assert fetched.read() == BODY
+
+    run(test)
+
+
+def test_size_limits():
+    async def test(fetcher, server, hits):
+        for path in ("/body", "/streamed"):
+            with pytest.raises(FetchError, match="too large"):
+                await fetcher.fetch(str(server.make_url(path)))
+        with pytest.raises(FetchError, match="404"):
+            await fetcher.fetch(str(server.make_url("/missing")))
+        assert not fetcher.in_flight
+
+    run(test, max_size=len(BODY) - 1)
@@ -0,0 +1,113 @@
+"""
+CachedMusicClient against a fake MusicClient.
+
+    python -m pytest tests
+"""
+import asyncio
+import os
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+
+from core.music.cache import CachedMusicClient
+
+SIZE = 1000
+
+
+class FakeMusicClient:
+    """ Counts requests, and holds downloads until `release` is set """
+    def __init__(self):
+        self.searches = []
+        self.downloads = []
+        self.release = asyncio.Event()
+
+    async def search(self, query: str):
+        self.searches.append(query)
+        await asyncio.sleep(0)
+        return [song(len(self.searches))]
+
+    async def download(self, song_):
+        self.downloads.append(song_.id)
+        await self.release.wait()
+        return BytesIO(bytes([song_.id % 256]) * song_.size), None
+
+
+def song(id_: int, size: int = SIZE):
+    return SimpleNamespace(id=id_, title=f"song {id_}", size=size)
+
+
+def run(test, **options):
+    async def main():
+        fake = FakeMusicClient()
+        await test(CachedMusicClient(fake, **options), fake)
+
+    asyncio.run(main())
+
+
+def test_concurrent_downloads_share_one(tmp_path):
+    async def test(client, fake):
+        waiting = [asyncio.ensure_future(client.download(song(1))) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        fake.release.set()
+        paths = await asyncio.gather(*waiting)
+
+        assert fake.downloads == [1]
+        assert len(set(paths)) == 1 and os.path.getsize(paths[0]) == SIZE
+        key = client.downloads.key("1")
+        assert client.downloads.pinned[key] == 5
+
+        for _ in range(5):
+            client.release(song(1))
+        await asyncio.sleep(0)
+        assert key not in client.downloads.pinned
+
+        # Cached now, so no new download
+        assert await client.download(song(1)) == paths[0]
+        assert fake.downloads == [1]
+
+    run(test, directory=str(tmp_path))
+
+
+def test_eviction_skips_pinned_files(tmp_path):
+    async def test(client, fake):
+        fake.release.set()
+        paths = [await client.download(song(i)) for i in range(3)]
+        # Over budget, but every file is still in use
+        assert all(os.path.exists(path) for path in paths)
+
+        client.release(song(0))
+        await asyncio.sleep(0)
+        assert not os.path.exists(paths[0])
+        assert os.path.exists(paths[1]) and os.path.exists(paths[2])
+
+        # Downloading again brings it back
+        assert os.path.getsize(await client.download(song(0))) == SIZE
+        assert fake.downloads == [0, 1, 2, 0]
+
+    run(test, directory=str(tmp_path), max_disk=2 * SIZE + SIZE // 2)
+
+
+def test_failed_download_unpins(tmp_path):
+    async def test(client, fake):
+        fake.release.set()
+        with pytest.raises(ValueError, match="too large"):
+            await client.download(song(1, size=10 * SIZE))
+        assert not client.downloads.pinned
+        assert not os.listdir(str(tmp_path))
+
+    run(test, directory=str(tmp_path), max_disk=SIZE)
+
+
+def test_searches_are_cached_and_coalesced(tmp_path):
+    async def test(client, fake):
+        first = await asyncio.gather(*(client.search("Some  Song") for _ in range(3)))
+        assert fake.searches == ["Some  Song"]
+        assert await client.search("some song") is first[0]
+        assert client.stats["search_hits"] == 1
+
+        await asyncio.sleep(0.06)
+        await client.search("some song")
+        assert len(fake.searches) == 2
+
+    run(test, directory=str(tmp_path), search_ttl=0.05)
@@ -0,0 +1,127 @@
+"""
+Checks ChunkedQueue against the original list-based implementation it
+replaced, which is kept below as the reference.
+
+    python -m pytest tests
+"""
+from typing import List, Optional, Tuple
+
+from hypothesis import given, settings, strategies as st
+
+from core.music.queues import ChunkedQueue
+
+
+class Song:
+    def __init__(self, n: int):
+        self.n = n
+
+    def cleanup(self):
+        pass
+
+
+class ReferenceChunkedQueue:
+    """ The chunk placement ChunkedQueue had as nested lists, scanned on every add """
+    def __init__(self, chunk_size=2, max_chunks=-1, max_per_user=-1):
+        self.size = chunk_size
+        self.max = max_chunks
+        self.user_max = max_per_user
+        self.items: List[List[Tuple[int, Song]]] = []
+        self.queue: List[Tuple[int, Song]] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.queue) or bool(self.items)
+
+    def add(self, source: Song, requester_id: int):
+        entry = (requester_id, source)
+        if not self.items:
+            self.items.append([entry])
+            return
+
+        if len(self.items) == self.max:
+            raise Exception("Max queue chunks reached.")
+        full = sum(1 for chunk in self.items if chunk[0][0] == requester_id and len(chunk) == self.size)
+        if full == self.user_max:
+            raise Exception("User reached maximum amount of chunks")
+
+        for index, chunk in enumerate(reversed(self.items)):
+            if index == len(self.items) - 1 or chunk[0][0] == requester_id:
+                if chunk[0][0] == requester_id and len(chunk) < self.size:
+                    chunk.append(entry)
+                    return
+
+                start = len(self.items) - index - 1
+                found_ids = []
+                while True:
+                    if start >= len(self.items):
+                        self.items.append([entry])
+                        return
+                    owner = self.items[start][0][0]
+                    if owner in found_ids:
+                        self.items.insert(start, [entry])
+                        return
+                    found_ids.append(owner)
+                    start += 1
+
+    def get(self) -> Song:
+        if not self.queue:
+            self.queue = self.items.pop(0)
+        return self.queue.pop(0)[1]
+
+    def peek(self) -> Song:
+        return (self.queue or self.items[0])[0][1]
+
+
+def chunk_owners(queue: ChunkedQueue) -> List[List[int]]:
+    owners = []
+    chunk = queue.head
+    while chunk is not None:
+        owners.append([owner for owner, _ in chunk.entries])
+        chunk = chunk.next
+    return owners
+
+
+def error(add, song: Song, user: int) -> Optional[str]:
+    try:
+        add(song, user)
+    except Exception as e:
+        return str(e)
+    return None
+
+
+# Either add a song for one of a few users, or take the next one
+operations = st.lists(st.one_of(st.integers(0, 5), st.none()), max_size=200)
+
+
+@settings(max_examples=300, deadline=None)
+@given(operations, st.integers(1, 3), st.sampled_from([-1, 5, 10]), st.sampled_from([-1, 1, 2, 3]))
+def test_chunked_queue_matches_reference(ops, chunk_size, max_chunks, max_per_user):
+    queue = ChunkedQueue(chunk_size, max_chunks, max_per_user)
+    reference = ReferenceChunkedQueue(chunk_size, max_chunks, max_per_user)
+
+    for n, user in enumerate(ops):
+        if user is None:
+            assert bool(queue) == bool(reference)
+            if reference:
+                assert queue.peek() is reference.peek()
+                assert queue.get_nowait() is reference.get()
+            continue
+
+        song = Song(n)
+        assert error(queue._add, song, user) == error(reference.add, song, user)
+
+        assert chunk_owners(queue) == [[owner for owner, _ in chunk] for chunk in reference.items]
+        assert [owner for owner, _ in queue.queue] == [owner for owner, _ in reference.queue]
+
+
+@given(st.lists(st.integers(0, 5), max_size=100), st.integers(1, 3))
+def test_chunked_queue_shuffle_keeps_songs(users, chunk_size):
+    queue = ChunkedQueue(chunk_size)
+    songs = [Song(n) for n in range(len(users))]
+    for song, user in zip(songs, users):
+        queue._add(song, user)
+    queue._shuffle()
+
+    out = []
+    while queue:
+        out.append(queue.get_nowait())
+    assert sorted(song.n for song in out) == list(range(len(users)))
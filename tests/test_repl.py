@@ -0,0 +1,62 @@
+"""
+Compiling and running eval snippets against a persistent namespace.
+
+    python -m pytest tests
+"""
+import asyncio
+import time
+from io import StringIO
+
+from cogs.custom_eval import EvalCog
+from core.repl import Session, compile_snippet, release_stdout, run_snippet
+
+
+def run(source: str, env: dict):
+    return asyncio.run(run_snippet(compile_snippet(source, env), 5))
+
+
+def test_names_persist_between_snippets():
+    env = {}
+    run("x = 41", env)
+    run("x += 1", env)
+    assert run("x", env) == 42
+    assert env["_"] == 42
+
+    run("y: int = 1\nfor i in range(3): y += i", env)
+    assert (env["y"], env["i"]) == (4, 2)
+    run("import os.path as p\ndef f(): return x", env)
+    assert run("f()", env) == 42 and "p" in env
+    run("del x", env)
+    assert "x" not in env
+
+
+def test_nested_scopes_stay_local():
+    env = {}
+    run("def f():\n    inner = 1\n    return inner\n[n for n in range(3)]\nf()", env)
+    assert "inner" not in env and "n" not in env
+    run("[last := n for n in range(3)]", env)
+    assert env["last"] == 2
+
+
+def test_async_snippets_bind_globals():
+    env = {"asyncio": asyncio}
+    run("await asyncio.sleep(0)\nz = 1", env)
+    run("z += 1", env)
+    assert env["z"] == 2
+
+
+
+def test_session_runs_one_at_a_time():
+    # A second eval must not take `ctx` away from one still running
+    cog = EvalCog(None)
+    session = Session({"time": time})
+
+    async def main():
+        return await asyncio.gather(cog.any_eval("time.sleep(0.2)\nctx", {"ctx": 1}, StringIO(), session),
+                                    cog.any_eval("ctx", {"ctx": 2}, StringIO(), session))
+
+    try:
+        assert asyncio.run(main()) == [1, 2]
+    finally:
+        release_stdout()
+    assert "ctx" not in session.env